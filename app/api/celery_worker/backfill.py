@@ -0,0 +1,120 @@
+import os
+import uuid
+import datetime
+import dateutil.relativedelta
+from databases.core import logger
+from finances.candles import CandleBatch
+from finances.throttler import get_redis
+from celery_worker.worker import celery_app
+from celery_worker.coverage import missing_intervals, add_coverage
+
+# Finnhub returns at most about this many candles per request, so a candle window spans that many bars.
+CANDLE_MAX_POINTS = int(float(os.getenv("FH_CANDLE_MAX_POINTS", "5000")))
+BACKFILL_TTL = 7 * 24 * 60 * 60
+# Finnhub's intraday stock candles include pre- and post-market, 4:00 to 20:00 on weekdays.
+STOCK_SESSION_HOURS = float(os.getenv("FH_STOCK_SESSION_HOURS", "16"))
+
+resolution_spans = {
+    "1": dateutil.relativedelta.relativedelta(minutes=1),
+    "5": dateutil.relativedelta.relativedelta(minutes=5),
+    "15": dateutil.relativedelta.relativedelta(minutes=15),
+    "30": dateutil.relativedelta.relativedelta(minutes=30),
+    "60": dateutil.relativedelta.relativedelta(hours=1),
+    "D": dateutil.relativedelta.relativedelta(days=1),
+    "W": dateutil.relativedelta.relativedelta(weeks=1),
+    "M": dateutil.relativedelta.relativedelta(months=1)
+}
+
+# Windows of the datasets that page by date; the others are fetched in a single window.
+window_spans = {
+    "company_news": dateutil.relativedelta.relativedelta(months=1),
+    "press_releases": dateutil.relativedelta.relativedelta(years=1)
+}
+
+
+def candle_span(resolution: str, trading: bool = False) -> dateutil.relativedelta.relativedelta:
+    # Stocks only trade in sessions on weekdays, so their windows cover the calendar time of that many traded bars.
+    span = resolution_spans[resolution] * CANDLE_MAX_POINTS
+    if trading and resolution == "D":
+        return span * (7 / 5)
+    if trading and resolution not in ("W", "M"):
+        return span * (24 * 7 / (STOCK_SESSION_HOURS * 5))
+    return span
+
+
+def plan_windows(
+    startdate: datetime.datetime, enddate: datetime.datetime, span: dateutil.relativedelta.relativedelta = None
+) -> list:
+    # Newest window first, so recent data lands before the deep history.
+    if span is None:
+        return [(startdate, enddate)]
+    windows = []
+    while enddate > startdate:
+        windows.append((max(startdate, enddate - span), enddate))
+        enddate = windows[-1][0]
+    return windows
+
+
+async def dispatch_backfill(
+    task: str, args: tuple, startdate: datetime.datetime, enddate: datetime.datetime,
+    span: dateutil.relativedelta.relativedelta = None, priority: int = 5
+):
+    # Only the intervals missing from the coverage are planned. All windows are queued at once; the throttler
+    # bounds how fast they actually hit the API.
+    windows = []
+    for start, end in reversed(await missing_intervals(task, args, startdate, enddate)):
+        windows += plan_windows(start, end, span)
+    if len(windows) == 0:
+        return
+    backfill_id = uuid.uuid4().hex
+    await get_redis().set(f"backfill:{backfill_id}", len(windows), ex=BACKFILL_TTL)
+    for start, end in windows:
+        await celery_app.send_task(
+            task, args=(*args, start, end), kwargs={"backfill_id": backfill_id}, priority=priority
+        )
+
+
+async def complete_window(
+    backfill_id: str, task: str, args: tuple,
+    startdate: datetime.datetime, enddate: datetime.datetime, priority: int = 5
+):
+    # The window is recorded as covered. Completion barrier: the last window to finish catches up on what was
+    # published while the backfill ran.
+    await add_coverage(task, args, startdate, enddate)
+    if backfill_id is None:
+        return
+    key = f"backfill:{backfill_id}"
+    if await get_redis().decr(key) == 0:
+        await get_redis().delete(key)
+        logger.info(f"Backfill `{task}` of {args} finished.")
+        await celery_app.send_task(task.replace("_full", "_latest"), args=args, priority=priority)
+
+
+def oldest_date(result) -> datetime.datetime:
+    if isinstance(result, CandleBatch):
+        return result.min_date()
+    return min([res["date"] for res in result])
+
+
+async def backfill_window(fetch, insert, startdate: datetime.datetime, enddate: datetime.datetime):
+    # Pages backwards inside one window until it is exhausted or the oldest date stops moving.
+    while startdate < enddate:
+        result = await fetch(startdate, enddate)
+        if len(result) == 0:
+            return
+        await insert(result)
+        prev_date = enddate
+        enddate = oldest_date(result)
+        if enddate == prev_date:
+            return
+
+
+async def refresh_windows(
+    task: str, args: tuple, fetch, insert, startdate: datetime.datetime, enddate: datetime.datetime,
+    span: dateutil.relativedelta.relativedelta = None
+):
+    # Oldest window first and each one paged like a backfill window, so the coverage only ever grows by what was
+    # really fetched and an interrupted refresh resumes where it stopped.
+    for start, end in reversed(plan_windows(startdate, enddate, span)):
+        await backfill_window(fetch, insert, start, end)
+        await add_coverage(task, args, start, end)
@@ -24,7 +24,6 @@ class CeleryConfig:
         'queue_order_strategy': 'priority',
     }
 
-    worker_max_tasks_per_child = 1
     worker_prefetch_multiplier = 1
 
     task_serializer = "pickle"
@@ -0,0 +1,50 @@
+import datetime
+from celery_worker.db_tasks import PostgresTask
+
+
+def coverage_key(task: str, args: tuple) -> dict:
+    # `stock_candles_full` and `stock_candles_latest` share the coverage of `stock_candles`.
+    return {
+        "dataset": task.rsplit("_", 1)[0],
+        "c_id": args[1],
+        "resolution": args[2] if len(args) > 2 else ""
+    }
+
+
+def subtract_intervals(covered: list, startdate: datetime.datetime, enddate: datetime.datetime) -> list:
+    gaps = []
+    for start, end in sorted(covered):
+        if start > startdate:
+            gaps.append((startdate, min(start, enddate)))
+        startdate = max(startdate, end)
+        if startdate >= enddate:
+            return gaps
+    if startdate < enddate:
+        gaps.append((startdate, enddate))
+    return gaps
+
+
+async def missing_intervals(task: str, args: tuple, startdate: datetime.datetime, enddate: datetime.datetime) -> list:
+    db = await PostgresTask.connected_db()
+    covered = await db.get_coverage(**coverage_key(task, args), startdate=startdate, enddate=enddate)
+    return subtract_intervals([(row["startdate"], row["enddate"]) for row in covered], startdate, enddate)
+
+
+async def covered_until(task: str, args: tuple) -> datetime.datetime:
+    db = await PostgresTask.connected_db()
+    return await db.get_covered_until(**coverage_key(task, args))
+
+
+async def add_coverage(task: str, args: tuple, startdate: datetime.datetime, enddate: datetime.datetime):
+    db = await PostgresTask.connected_db()
+    await db.insert_coverage(**coverage_key(task, args), startdate=startdate, enddate=enddate)
+
+
+async def refresh_interval(task: str, args: tuple, get_watermark) -> tuple:
+    # Starts where the coverage ends, or at the watermark for data fetched before coverage was recorded.
+    startdate = await covered_until(task, args)
+    if startdate is None:
+        startdate = await get_watermark()
+        if startdate is None:
+            return None
+    return startdate, datetime.datetime.now()
@@ -1,38 +1,94 @@
+import os
+import time
+import asyncio
+import concurrent.futures
 from async_property import async_property
 from databases.core import logger
-from db import PgCrud, MongoCrud
+from db import pg_db, mongo_db
+from finances import fh, fm
 from celery import Task
+from celery.signals import worker_shutdown
 
-from asyncpg.exceptions import ConnectionDoesNotExistError
+from asyncpg.exceptions import ConnectionDoesNotExistError, PostgresConnectionError
 from asyncpg.exceptions._base import InterfaceError
 from aiohttp import ContentTypeError
+from finances.throttler import TransientRequestError
 
 
 class PostgresTask(Task):
-    _db = None
-    autoretry_for = (InterfaceError, ConnectionDoesNotExistError, ContentTypeError, )
+    # Every task of the worker process shares the `pg_db` pool. It is pinged at most every `health_interval` seconds
+    # and rebuilt when the ping fails, so a restarted server does not leave dead connections behind.
+    autoretry_for = (InterfaceError, ConnectionDoesNotExistError, ContentTypeError, TransientRequestError, )
     retry_kwargs = {"max_retries": 12, "countdown": 10}
+    health_interval = float(os.getenv("WORKER_HEALTH_INTERVAL", "30"))
+
+    _lock = None
+    _checked_at = 0
 
     @async_property
     async def db(self):
-        if self._db is None:
-            db = PgCrud()
+        return await PostgresTask.connected_db()
+
+    @classmethod
+    async def connected_db(cls):
+        # Also used by tasks of other bases that need Postgres, e.g. for the fetch coverage.
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+        async with cls._lock:
+            if not pg_db.is_connected or time.monotonic() - cls._checked_at >= cls.health_interval:
+                await cls.check_connection()
+                cls._checked_at = time.monotonic()
+        return pg_db
+
+    @staticmethod
+    async def check_connection():
+        if pg_db.is_connected:
             try:
-                await db.connect()
-            except AssertionError as e:
-                logger.warning(f"Skipping. {str(e)}")
-            finally:
-                self._db = db
-        return self._db
+                await pg_db.execute("SELECT 1")
+                return
+            except (OSError, InterfaceError, PostgresConnectionError) as e:
+                logger.warning(f"Reconnecting to Postgres. {str(e)}")
+                await pg_db.disconnect()
+        await pg_db.connect()
 
 
 class MongoTask(Task):
-    _db = None
-    autoretry_for = (ContentTypeError, )
+    # Motor keeps its own pool healthy (server monitoring and reconnects), so the shared client is only set up once.
+    autoretry_for = (ContentTypeError, TransientRequestError, )
     retry_kwargs = {"max_retries": 12, "countdown": 10}
 
+    _indexed = False
+
     @async_property
     async def db(self):
-        if self._db is None:
-            self._db = MongoCrud()
-        return self._db
+        if not MongoTask._indexed:
+            await mongo_db.ensure_indexes()
+            MongoTask._indexed = True
+        return mongo_db
+
+
+SHUTDOWN_TIMEOUT = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "10"))
+
+
+async def close_connections():
+    if pg_db.is_connected:
+        await pg_db.disconnect()
+    mongo_db.close()
+    await fh.close()
+    await fm.close()
+
+
+@worker_shutdown.connect
+def close_worker_connections(**kwargs):
+    # The asyncio pool runs its loop in a thread. After a warm shutdown the loop is stopped and can be run here, after
+    # a shutdown from a signal handler it is still running and the close is handed to it.
+    loop = asyncio.get_event_loop()
+    if loop.is_closed():
+        return
+    if not loop.is_running():
+        loop.run_until_complete(close_connections())
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close_connections(), loop).result(SHUTDOWN_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        logger.warning(f"Connections still open after {SHUTDOWN_TIMEOUT}s of shutdown.")
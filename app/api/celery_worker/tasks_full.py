@@ -3,6 +3,9 @@ import dateutil.relativedelta
 from finances import fh
 from celery_worker.worker import celery_app
 from celery_worker.db_tasks import PostgresTask, MongoTask
+from celery_worker.backfill import (
+    dispatch_backfill, complete_window, backfill_window, candle_span, window_spans
+)
 
 HORIZON_YEARS_MARKET = 10
 HORIZON_DAYS_MARKET = 21
@@ -23,15 +26,15 @@ async def add_company_parsing_tasks(symbol: str, c_id: int, ipo: datetime.dateti
     if ipo is not None:
         startdate = max(startdate, ipo)
     for resolution, priority in zip(fh.resolutions, fh.priorities):
-        await celery_app.send_task(
-            "stock_candles_full", args=(symbol, c_id, resolution, startdate, enddate), priority=priority
+        await dispatch_backfill(
+            "stock_candles_full", (symbol, c_id, resolution), startdate, enddate,
+            span=candle_span(resolution, trading=True), priority=priority
         )
 
-    await celery_app.send_task("sentiments_full", args=(symbol, c_id, startdate, enddate), priority=5)
-    await celery_app.send_task("dividends_full", args=(symbol, c_id, startdate, enddate), priority=5)
-    await celery_app.send_task("splits_full", args=(symbol, c_id, startdate, enddate), priority=5)
-    await celery_app.send_task("upgrades_downgrades_full", args=(symbol, c_id, startdate, enddate), priority=5)
-    await celery_app.send_task("earnings_calendars_full", args=(symbol, c_id, startdate, enddate), priority=5)
+    for task in [
+        "sentiments_full", "dividends_full", "splits_full", "upgrades_downgrades_full", "earnings_calendars_full"
+    ]:
+        await dispatch_backfill(task, (symbol, c_id), startdate, enddate)
 
     await celery_app.send_task("balance_sheets_full", args=(symbol, c_id), priority=5)
     await celery_app.send_task("cash_flows_full", args=(symbol, c_id), priority=5)
@@ -47,41 +50,50 @@ async def add_company_parsing_tasks(symbol: str, c_id: int, ipo: datetime.dateti
     startdate = enddate - dateutil.relativedelta.relativedelta(years=HORIZON_YEARS_NEWS_RELEASES)
     if ipo is not None:
         startdate = max(startdate, ipo)
-    await celery_app.send_task("company_news_full", args=(symbol, c_id, startdate, enddate), priority=5)
-    await celery_app.send_task("press_releases_full", args=(symbol, c_id, startdate, enddate), priority=5)
+    for task in ["company_news_full", "press_releases_full"]:
+        await dispatch_backfill(task, (symbol, c_id), startdate, enddate, span=window_spans[task.replace("_full", "")])
+
+
+@celery_app.task(name="add_crypto_parsing_tasks")
+async def add_crypto_parsing_tasks(symbol: str, c_id: int):
+    enddate = datetime.datetime.now()
+    startdate = enddate - dateutil.relativedelta.relativedelta(years=HORIZON_YEARS_MARKET)
+    for resolution, priority in zip(fh.resolutions, fh.priorities):
+        await dispatch_backfill(
+            "crypto_candles_full", (symbol, c_id, resolution), startdate, enddate,
+            span=candle_span(resolution), priority=priority
+        )
 
 
 @celery_app.task(name="stock_candles_full", base=PostgresTask, bind=True)
 async def full_retrieve_stock_candles(
     self, symbol: str, c_id: int, resolution: str,
-    startdate: datetime.datetime, enddate: datetime.datetime
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
 ):
-    result = await fh.get_stock_candles(symbol, resolution, startdate, enddate)
-    if len(result) != 0 and startdate + dateutil.relativedelta.relativedelta(days=1) < enddate:
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate != prev_date:
-            result = fill_name_value(result, "c_id", c_id)
-            result = fill_name_value(result, "resolution", resolution)
-            await (await self.db).insert_stock_candles(result)
-            await celery_app.send_task(
-                "stock_candles_full", args=(symbol, c_id, resolution, startdate, enddate),
-                priority=fh.priorities[fh.resolutions.index(resolution)]
-            )
+    db = await self.db
+    await backfill_window(
+        lambda start, end: fh.get_stock_candles(symbol, resolution, start, end),
+        lambda result: db.insert_stock_candles(result.with_constants(c_id=c_id)),
+        startdate, enddate
+    )
+    await complete_window(
+        backfill_id, "stock_candles_full", (symbol, c_id, resolution), startdate, enddate,
+        priority=fh.priorities[fh.resolutions.index(resolution)]
+    )
 
 
 @celery_app.task(name="company_news_full", base=MongoTask, bind=True)
 async def full_retrieve_company_news(
     self, symbol: str, c_id: int,
-    startdate: datetime.datetime, enddate: datetime.datetime
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
 ):
-    result = await fh.get_company_news(symbol, startdate, enddate)
-    if len(result) != 0 and startdate + dateutil.relativedelta.relativedelta(days=1) < enddate:
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate != prev_date:
-            await (await self.db).insert_company_news(fill_name_value(result, "c_id", c_id))
-            await celery_app.send_task("company_news_full", args=(symbol, c_id, startdate, enddate), priority=5)
+    db = await self.db
+    await backfill_window(
+        lambda start, end: fh.get_company_news(symbol, start, end),
+        lambda result: db.insert_company_news(fill_name_value(result, "c_id", c_id)),
+        startdate, enddate
+    )
+    await complete_window(backfill_id, "company_news_full", (symbol, c_id), startdate, enddate)
 
 
 @celery_app.task(name="balance_sheets_full", base=MongoTask, bind=True)
@@ -115,55 +127,60 @@ async def full_retrieve_similarities(self, symbol: str, c_id: int):
 @celery_app.task(name="sentiments_full", base=PostgresTask, bind=True)
 async def full_retrieve_sentiments(
     self, symbol: str, c_id: int,
-    startdate: datetime.datetime, enddate: datetime.datetime
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
 ):
-    filings = await fh.get_filings(symbol, startdate, enddate)
-    result = await fh.get_sec_sentiments(filings)
-    if len(result) != 0 and startdate + dateutil.relativedelta.relativedelta(days=1) < enddate:
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate != prev_date:
-            await (await self.db).insert_sec_sentiment(fill_name_value(result, "c_id", c_id))
-            await celery_app.send_task("sentiments_full", args=(symbol, c_id, startdate, enddate), priority=5)
+    async def fetch(start, end):
+        return await fh.get_sec_sentiments(await fh.get_filings(symbol, start, end))
+
+    db = await self.db
+    await backfill_window(
+        fetch,
+        lambda result: db.insert_sec_sentiment(fill_name_value(result, "c_id", c_id)),
+        startdate, enddate
+    )
+    await complete_window(backfill_id, "sentiments_full", (symbol, c_id), startdate, enddate)
 
 
 @celery_app.task(name="dividends_full", base=PostgresTask, bind=True)
 async def full_retrieve_dividends(
     self, symbol: str, c_id: int,
-    startdate: datetime.datetime, enddate: datetime.datetime
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
 ):
-    result = await fh.get_dividends(symbol, startdate, enddate)
-    if len(result) != 0 and startdate + dateutil.relativedelta.relativedelta(days=1) < enddate:
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate != prev_date:
-            await (await self.db).insert_dividends(fill_name_value(result, "c_id", c_id))
-            await celery_app.send_task("dividends_full", args=(symbol, c_id, startdate, enddate), priority=5)
+    db = await self.db
+    await backfill_window(
+        lambda start, end: fh.get_dividends(symbol, start, end),
+        lambda result: db.insert_dividends(fill_name_value(result, "c_id", c_id)),
+        startdate, enddate
+    )
+    await complete_window(backfill_id, "dividends_full", (symbol, c_id), startdate, enddate)
 
 
 @celery_app.task(name="press_releases_full", base=MongoTask, bind=True)
 async def full_retrieve_press_releases(
     self, symbol: str, c_id: int,
-    startdate: datetime.datetime, enddate: datetime.datetime
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
 ):
-    result = await fh.get_press_releases(symbol, startdate, enddate)
-    if len(result) != 0 and startdate + dateutil.relativedelta.relativedelta(days=1) < enddate:
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate != prev_date:
-            await (await self.db).insert_press_releases(fill_name_value(result, "c_id", c_id))
-            await celery_app.send_task("press_releases_full", args=(symbol, c_id, startdate, enddate), priority=5)
+    db = await self.db
+    await backfill_window(
+        lambda start, end: fh.get_press_releases(symbol, start, end),
+        lambda result: db.insert_press_releases(fill_name_value(result, "c_id", c_id)),
+        startdate, enddate
+    )
+    await complete_window(backfill_id, "press_releases_full", (symbol, c_id), startdate, enddate)
 
 
 @celery_app.task(name="splits_full", base=PostgresTask, bind=True)
-async def full_retrieve_splits(self, symbol: str, c_id: int, startdate: datetime.datetime, enddate: datetime.datetime):
-    result = await fh.get_splits(symbol, startdate, enddate)
-    if len(result) != 0 and startdate + dateutil.relativedelta.relativedelta(days=1) < enddate:
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate != prev_date:
-            await (await self.db).insert_splits(fill_name_value(result, "c_id", c_id))
-            await celery_app.send_task("splits_full", args=(symbol, c_id, startdate, enddate), priority=5)
+async def full_retrieve_splits(
+    self, symbol: str, c_id: int,
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
+):
+    db = await self.db
+    await backfill_window(
+        lambda start, end: fh.get_splits(symbol, start, end),
+        lambda result: db.insert_splits(fill_name_value(result, "c_id", c_id)),
+        startdate, enddate
+    )
+    await complete_window(backfill_id, "splits_full", (symbol, c_id), startdate, enddate)
 
 
 @celery_app.task(name="trends_full", base=PostgresTask, bind=True)
@@ -197,44 +214,43 @@ async def full_retrieve_revenue_estimates(self, symbol: str, c_id: int):
 @celery_app.task(name="upgrades_downgrades_full", base=PostgresTask, bind=True)
 async def full_retrieve_upgrades_downgrades(
     self, symbol: str, c_id: int,
-    startdate: datetime.datetime, enddate: datetime.datetime
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
 ):
-    result = await fh.get_upgrades_downgrades(symbol, startdate, enddate)
-    if len(result) != 0 and startdate + dateutil.relativedelta.relativedelta(days=1) < enddate:
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate != prev_date:
-            await (await self.db).insert_upgrades_downgrades(fill_name_value(result, "c_id", c_id))
-            await celery_app.send_task("upgrades_downgrades_full", args=(symbol, c_id, startdate, enddate), priority=5)
+    db = await self.db
+    await backfill_window(
+        lambda start, end: fh.get_upgrades_downgrades(symbol, start, end),
+        lambda result: db.insert_upgrades_downgrades(fill_name_value(result, "c_id", c_id)),
+        startdate, enddate
+    )
+    await complete_window(backfill_id, "upgrades_downgrades_full", (symbol, c_id), startdate, enddate)
 
 
 @celery_app.task(name="earnings_calendars_full", base=PostgresTask, bind=True)
 async def full_retrieve_earnings_calendars(
     self, symbol: str, c_id: int,
-    startdate: datetime.datetime, enddate: datetime.datetime
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
 ):
-    result = await fh.get_earnings_calendars(symbol, startdate, enddate)
-    if len(result) != 0 and startdate + dateutil.relativedelta.relativedelta(days=1) < enddate:
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate != prev_date:
-            await (await self.db).insert_earnings_calendars(fill_name_value(result, "c_id", c_id))
-            await celery_app.send_task("earnings_calendars_full", args=(symbol, c_id, startdate, enddate), priority=5)
+    db = await self.db
+    await backfill_window(
+        lambda start, end: fh.get_earnings_calendars(symbol, start, end),
+        lambda result: db.insert_earnings_calendars(fill_name_value(result, "c_id", c_id)),
+        startdate, enddate
+    )
+    await complete_window(backfill_id, "earnings_calendars_full", (symbol, c_id), startdate, enddate)
 
 
 @celery_app.task(name="crypto_candles_full", base=PostgresTask, bind=True)
 async def full_retrieve_crypto_candles(
     self, symbol: str, c_id: int, resolution: str,
-    startdate: datetime.datetime, enddate: datetime.datetime
+    startdate: datetime.datetime, enddate: datetime.datetime, backfill_id: str = None
 ):
-    while True:
-        result = await fh.get_crypto_candles(symbol, resolution, startdate, enddate)
-        if len(result) == 0 or startdate + dateutil.relativedelta.relativedelta(days=1) >= enddate:
-            return
-        result = fill_name_value(result, "c_id", c_id)
-        result = fill_name_value(result, "resolution", resolution)
-        prev_date = enddate
-        enddate = min([res["date"] for res in result])
-        if enddate == prev_date:
-            return
-        await (await self.db).insert_crypto_candles(result)
+    db = await self.db
+    await backfill_window(
+        lambda start, end: fh.get_crypto_candles(symbol, resolution, start, end),
+        lambda result: db.insert_crypto_candles(result.with_constants(c_id=c_id)),
+        startdate, enddate
+    )
+    await complete_window(
+        backfill_id, "crypto_candles_full", (symbol, c_id, resolution), startdate, enddate,
+        priority=fh.priorities[fh.resolutions.index(resolution)]
+    )
@@ -1,7 +1,8 @@
-import datetime
 from finances import fh, fm
 from celery_worker.worker import celery_app
 from celery_worker.db_tasks import PostgresTask, MongoTask
+from celery_worker.coverage import refresh_interval
+from celery_worker.backfill import refresh_windows, candle_span, window_spans
 
 
 def fill_name_value(results, name, value):
@@ -10,188 +11,230 @@ def fill_name_value(results, name, value):
     return results
 
 
+def newer_than(results, watermark):
+    # Endpoints without a date range return the whole history; only what is past the watermark is inserted.
+    if watermark is None:
+        return results
+    return [res for res in results if res["date"] is not None and res["date"] > watermark]
+
+
 @celery_app.task(name="stock_candles_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_stock_candles(self, symbol: str, c_id: int, resolution: str):
-    latest = await (await self.db).get_stock_candles(symbol, resolution, 10)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id, resolution)
+    interval = await refresh_interval(
+        "stock_candles_latest", args, lambda: db.get_watermark("stocks_candles", c_id, resolution)
+    )
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_stock_candles(symbol, resolution, startdate, enddate)
-    if len(result) != 0:
-        result = fill_name_value(result, "c_id", c_id)
-        result = fill_name_value(result, "resolution", resolution)
-        await (await self.db).insert_stock_candles(result)
+    await refresh_windows(
+        "stock_candles_latest", args,
+        lambda start, end: fh.get_stock_candles(symbol, resolution, start, end),
+        lambda result: db.insert_stock_candles(result.with_constants(c_id=c_id)),
+        *interval, span=candle_span(resolution, trading=True)
+    )
 
 
 @celery_app.task(name="company_news_latest", base=MongoTask, bind=True)
 async def latest_retrieve_company_news(self, symbol: str, c_id: int):
-    latest = await (await self.db).get_company_news(symbol)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id)
+    interval = await refresh_interval("company_news_latest", args, lambda: db.get_watermark("company_news", symbol))
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_company_news(symbol, startdate, enddate)
-    if len(result) != 0:
-        await (await self.db).insert_company_news(fill_name_value(result, "c_id", c_id))
+    await refresh_windows(
+        "company_news_latest", args,
+        lambda start, end: fh.get_company_news(symbol, start, end),
+        lambda result: db.insert_company_news(fill_name_value(result, "c_id", c_id)),
+        *interval, span=window_spans["company_news"]
+    )
 
 
 @celery_app.task(name="balance_sheets_latest", base=MongoTask, bind=True)
 async def latest_retrieve_balance_sheets(self, symbol: str, c_id: int):
-    result = await fh.get_balance_sheets(symbol)
-    latest = await (await self.db).get_balance_sheets(symbol)
-    result = [res for res in result if res["date"] > latest[0]["date"]]
+    db = await self.db
+    watermark = await db.get_watermark("balance_sheets", symbol)
+    result = newer_than(await fh.get_balance_sheets(symbol), watermark)
     if len(result) != 0:
-        await (await self.db).insert_balance_sheets(fill_name_value(result, "c_id", c_id))
+        await db.insert_balance_sheets(fill_name_value(result, "c_id", c_id))
 
 
 @celery_app.task(name="cash_flows_latest", base=MongoTask, bind=True)
 async def latest_retrieve_cash_flows(self, symbol: str, c_id: int):
-    result = await fh.get_cash_flows(symbol)
-    latest = await (await self.db).get_cash_flows(symbol)
-    result = [res for res in result if res["date"] > latest[0]["date"]]
+    db = await self.db
+    watermark = await db.get_watermark("cash_flows", symbol)
+    result = newer_than(await fh.get_cash_flows(symbol), watermark)
     if len(result) != 0:
-        await (await self.db).insert_cash_flows(fill_name_value(result, "c_id", c_id))
+        await db.insert_cash_flows(fill_name_value(result, "c_id", c_id))
 
 
 @celery_app.task(name="income_statements_latest", base=MongoTask, bind=True)
 async def latest_retrieve_income_statements(self, symbol: str, c_id: int):
-    result = await fh.get_income_statements(symbol)
-    latest = await (await self.db).get_income_statements(symbol)
-    result = [res for res in result if res["date"] > latest[0]["date"]]
+    db = await self.db
+    watermark = await db.get_watermark("income_statements", symbol)
+    result = newer_than(await fh.get_income_statements(symbol), watermark)
     if len(result) != 0:
-        await (await self.db).insert_income_statements(fill_name_value(result, "c_id", c_id))
+        await db.insert_income_statements(fill_name_value(result, "c_id", c_id))
 
 
 @celery_app.task(name="similarities_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_similarities(self, symbol: str, c_id: int):
-    result = await fh.get_similarity_index(symbol)
-    latest = await (await self.db).get_sec_similarities(symbol, 10)
-    result = [res for res in result if res["date"] > latest[0]["date"]]
+    db = await self.db
+    watermark = await db.get_watermark("sec_similarity", c_id)
+    result = newer_than(await fh.get_similarity_index(symbol), watermark)
     if len(result) != 0:
-        await (await self.db).insert_sec_similarity(fill_name_value(result, "c_id", c_id))
+        await db.insert_sec_similarity(fill_name_value(result, "c_id", c_id))
 
 
 @celery_app.task(name="sentiments_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_sentiments(self, symbol: str, c_id: int):
-    latest = await (await self.db).get_sec_sentiments(symbol, 10)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id)
+    interval = await refresh_interval("sentiments_latest", args, lambda: db.get_watermark("sec_sentiment", c_id))
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_sec_sentiments(await fh.get_filings(symbol, startdate, enddate))
-    if len(result) != 0:
-        await (await self.db).insert_sec_sentiment(fill_name_value(result, "c_id", c_id))
+
+    async def fetch(start, end):
+        return await fh.get_sec_sentiments(await fh.get_filings(symbol, start, end))
+
+    await refresh_windows(
+        "sentiments_latest", args,
+        fetch,
+        lambda result: db.insert_sec_sentiment(fill_name_value(result, "c_id", c_id)),
+        *interval
+    )
 
 
 @celery_app.task(name="dividends_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_dividends(self, symbol: str, c_id: int):
-    latest = await (await self.db).get_dividends(symbol, 10)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id)
+    interval = await refresh_interval("dividends_latest", args, lambda: db.get_watermark("dividends", c_id))
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_dividends(symbol, startdate, enddate)
-    if len(result) != 0:
-        await (await self.db).insert_dividends(fill_name_value(result, "c_id", c_id))
+    await refresh_windows(
+        "dividends_latest", args,
+        lambda start, end: fh.get_dividends(symbol, start, end),
+        lambda result: db.insert_dividends(fill_name_value(result, "c_id", c_id)),
+        *interval
+    )
 
 
 @celery_app.task(name="press_releases_latest", base=MongoTask, bind=True)
 async def latest_retrieve_press_releases(self, symbol: str, c_id: int):
-    latest = await (await self.db).get_press_releases(symbol)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id)
+    interval = await refresh_interval("press_releases_latest", args, lambda: db.get_watermark("press_releases", symbol))
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_press_releases(symbol, startdate, enddate)
-    if len(result) != 0:
-        await (await self.db).insert_press_releases(fill_name_value(result, "c_id", c_id))
+    await refresh_windows(
+        "press_releases_latest", args,
+        lambda start, end: fh.get_press_releases(symbol, start, end),
+        lambda result: db.insert_press_releases(fill_name_value(result, "c_id", c_id)),
+        *interval, span=window_spans["press_releases"]
+    )
 
 
 @celery_app.task(name="splits_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_splits(self, symbol: str, c_id: int):
-    latest = await (await self.db).get_splits(symbol)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id)
+    interval = await refresh_interval("splits_latest", args, lambda: db.get_watermark("splits", c_id))
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_splits(symbol, startdate, enddate)
-    if len(result) != 0:
-        await (await self.db).insert_splits(fill_name_value(result, "c_id", c_id))
+    await refresh_windows(
+        "splits_latest", args,
+        lambda start, end: fh.get_splits(symbol, start, end),
+        lambda result: db.insert_splits(fill_name_value(result, "c_id", c_id)),
+        *interval
+    )
 
 
 @celery_app.task(name="trends_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_trends(self, symbol: str, c_id: int):
-    result = await fh.get_trends(symbol)
-    latest = await (await self.db).get_trends(symbol)
-    result = [res for res in result if res["date"] > latest[0]["date"]]
+    db = await self.db
+    watermark = await db.get_watermark("trends", c_id)
+    result = newer_than(await fh.get_trends(symbol), watermark)
     if len(result) != 0:
-        await (await self.db).insert_trends(fill_name_value(result, "c_id", c_id))
+        await db.insert_trends(fill_name_value(result, "c_id", c_id))
 
 
 @celery_app.task(name="eps_surprises_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_eps_surprises(self, symbol: str, c_id: int):
-    result = await fh.get_eps_surprises(symbol)
-    latest = await (await self.db).get_eps_surprises(symbol)
-    result = [res for res in result if res["date"] > latest[0]["date"]]
+    db = await self.db
+    watermark = await db.get_watermark("eps_surprises", c_id)
+    result = newer_than(await fh.get_eps_surprises(symbol), watermark)
     if len(result) != 0:
-        await (await self.db).insert_eps_surprises(fill_name_value(result, "c_id", c_id))
+        await db.insert_eps_surprises(fill_name_value(result, "c_id", c_id))
 
 
 @celery_app.task(name="eps_estimates_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_eps_estimates(self, symbol: str, c_id: int):
-    result = await fh.get_eps_estimates(symbol)
-    latest = await (await self.db).get_eps_estimates(symbol)
-    result = [res for res in result if res["date"] > latest[0]["date"]]
+    db = await self.db
+    watermark = await db.get_watermark("eps_estimates", c_id)
+    result = newer_than(await fh.get_eps_estimates(symbol), watermark)
     if len(result) != 0:
-        await (await self.db).insert_eps_estimates(fill_name_value(result, "c_id", c_id))
+        await db.insert_eps_estimates(fill_name_value(result, "c_id", c_id))
 
 
 @celery_app.task(name="revenue_estimates_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_revenue_estimates(self, symbol: str, c_id: int):
-    result = await fh.get_revenue_estimates(symbol)
-    latest = await (await self.db).get_revenue_estimates(symbol)
-    result = [res for res in result if res["date"] > latest[0]["date"]]
+    db = await self.db
+    watermark = await db.get_watermark("revenue_estimates", c_id)
+    result = newer_than(await fh.get_revenue_estimates(symbol), watermark)
     if len(result) != 0:
-        await (await self.db).insert_revenue_estimates(fill_name_value(result, "c_id", c_id))
+        await db.insert_revenue_estimates(fill_name_value(result, "c_id", c_id))
 
 
 @celery_app.task(name="upgrades_downgrades_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_upgrades_downgrades(self, symbol: str, c_id: int):
-    latest = await (await self.db).get_upgrades_downgrades(symbol)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id)
+    interval = await refresh_interval(
+        "upgrades_downgrades_latest", args, lambda: db.get_watermark("upgrades_downgrades", c_id)
+    )
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_upgrades_downgrades(symbol, startdate, enddate)
-    if len(result) != 0:
-        await (await self.db).insert_upgrades_downgrades(fill_name_value(result, "c_id", c_id))
+    await refresh_windows(
+        "upgrades_downgrades_latest", args,
+        lambda start, end: fh.get_upgrades_downgrades(symbol, start, end),
+        lambda result: db.insert_upgrades_downgrades(fill_name_value(result, "c_id", c_id)),
+        *interval
+    )
 
 
 @celery_app.task(name="earnings_calendars_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_earnings_calendars(self, symbol: str, c_id: int):
-    latest = await (await self.db).get_earnings_calendars(symbol)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id)
+    interval = await refresh_interval(
+        "earnings_calendars_latest", args, lambda: db.get_watermark("earnings_calendars", c_id)
+    )
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_earnings_calendars(symbol, startdate, enddate)
-    if len(result) != 0:
-        await (await self.db).insert_earnings_calendars(fill_name_value(result, "c_id", c_id))
+    await refresh_windows(
+        "earnings_calendars_latest", args,
+        lambda start, end: fh.get_earnings_calendars(symbol, start, end),
+        lambda result: db.insert_earnings_calendars(fill_name_value(result, "c_id", c_id)),
+        *interval
+    )
 
 
 @celery_app.task(name="crypto_candles_latest", base=PostgresTask, bind=True)
 async def latest_retrieve_crypto_candles(self, symbol: str, c_id: int, resolution: str):
-    latest = await (await self.db).get_crypto_candles(symbol, resolution, 10)
-    if len(latest) == 0:
+    db = await self.db
+    args = (symbol, c_id, resolution)
+    interval = await refresh_interval(
+        "crypto_candles_latest", args, lambda: db.get_watermark("crypto_candles", c_id, resolution)
+    )
+    if interval is None:
         return
-    startdate = latest[0]["date"]
-    enddate = datetime.datetime.now()
-    result = await fh.get_crypto_candles(symbol, resolution, startdate, enddate)
-    if len(result) != 0:
-        result = fill_name_value(result, "c_id", c_id)
-        result = fill_name_value(result, "resolution", resolution)
-        await (await self.db).insert_crypto_candles(result)
+    await refresh_windows(
+        "crypto_candles_latest", args,
+        lambda start, end: fh.get_crypto_candles(symbol, resolution, start, end),
+        lambda result: db.insert_crypto_candles(result.with_constants(c_id=c_id)),
+        *interval, span=candle_span(resolution)
+    )
 
 
 @celery_app.task(name="finimize_latest", base=MongoTask, bind=True)
@@ -51,7 +51,7 @@ async def update_weekly(self):
 
     cryptos = await (await self.db).get_cryptos()
     for crypto in cryptos:
-        await celery_app.send_task("stock_candles_latest", args=(crypto["symbol"], crypto["id"], "W"), priority=10)
+        await celery_app.send_task("crypto_candles_latest", args=(crypto["symbol"], crypto["id"], "W"), priority=10)
 
 
 @celery_app.task(name="update_monthly", base=PostgresTask, bind=True)
@@ -75,4 +75,4 @@ async def update_monthly(self):
 
     cryptos = await (await self.db).get_cryptos()
     for crypto in cryptos:
-        await celery_app.send_task("stock_candles_latest", args=(crypto["symbol"], crypto["id"], "M"), priority=10)
+        await celery_app.send_task("crypto_candles_latest", args=(crypto["symbol"], crypto["id"], "M"), priority=10)
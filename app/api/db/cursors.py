@@ -0,0 +1,28 @@
+import json
+import base64
+import datetime
+import binascii
+
+
+class Page(list):
+    # Rows of a single page plus the opaque cursor of the page after it (None on the last page).
+
+    def __init__(self, rows: list, limit: int, key: str = "id"):
+        super(Page, self).__init__(rows)
+        self.next_cursor = None
+        if limit and len(rows) == limit:
+            self.next_cursor = encode_cursor(rows[-1]["date"], rows[-1].get(key))
+
+
+def encode_cursor(date: datetime.datetime, _id) -> str:
+    # Rows without a date sort after all the dated ones; their cursor carries a null date.
+    payload = json.dumps([date.isoformat() if date is not None else None, _id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        date, _id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(date) if date is not None else None, _id
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor `{cursor}`.") from e
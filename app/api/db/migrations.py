@@ -0,0 +1,119 @@
+# Idempotent schema changes applied at startup. `init_postgres.sql` only runs on a fresh volume, existing
+# databases get the objects added since then from here.
+migrations = [
+    """
+    CREATE OR REPLACE FUNCTION "create_monthly_partitions" ("parent" text, "startdate" timestamp, "enddate" timestamp)
+    RETURNS void AS $$
+    DECLARE
+      "month" timestamp := date_trunc('month', "startdate");
+    BEGIN
+      PERFORM pg_advisory_xact_lock(hashtext("parent"));
+      WHILE "month" <= "enddate" LOOP
+        EXECUTE format(
+          'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+          "parent" || '_' || to_char("month", 'YYYY_MM'), "parent", "month", "month" + interval '1 month'
+        );
+        "month" := "month" + interval '1 month';
+      END LOOP;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS "stocks_candles_packed" (
+      "c_id" integer NOT NULL REFERENCES "companies" ("id"),
+      "resolution" varchar(2) NOT NULL,
+      "day" date NOT NULL,
+      "time" integer[] NOT NULL,
+      "open" double precision[] NOT NULL,
+      "high" double precision[] NOT NULL,
+      "low" double precision[] NOT NULL,
+      "close" double precision[] NOT NULL,
+      "volume" bigint[] NOT NULL,
+      PRIMARY KEY ("c_id", "resolution", "day")
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS "crypto_candles_packed" (
+      "c_id" integer NOT NULL REFERENCES "crypto" ("id"),
+      "resolution" varchar(2) NOT NULL,
+      "day" date NOT NULL,
+      "time" integer[] NOT NULL,
+      "open" double precision[] NOT NULL,
+      "high" double precision[] NOT NULL,
+      "low" double precision[] NOT NULL,
+      "close" double precision[] NOT NULL,
+      "volume" bigint[] NOT NULL,
+      PRIMARY KEY ("c_id", "resolution", "day")
+    )
+    """,
+    # Packed prices were first declared float(8)[], which Postgres stores as real[].
+    """
+    DO $$
+    DECLARE
+      "col" record;
+    BEGIN
+      FOR "col" IN
+        SELECT "table_name", "column_name" FROM information_schema.columns
+        WHERE "table_name" IN ('stocks_candles_packed', 'crypto_candles_packed')
+          AND "column_name" IN ('open', 'high', 'low', 'close') AND "udt_name" = '_float4'
+      LOOP
+        EXECUTE format(
+          'ALTER TABLE %I ALTER COLUMN %I TYPE double precision[]', "col"."table_name", "col"."column_name"
+        );
+      END LOOP;
+    END;
+    $$
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS "fetch_coverage" (
+      "dataset" varchar(32) NOT NULL,
+      "c_id" integer NOT NULL,
+      "resolution" varchar(2) NOT NULL,
+      "startdate" timestamp NOT NULL,
+      "enddate" timestamp NOT NULL,
+      PRIMARY KEY ("dataset", "c_id", "resolution", "startdate")
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION "merge_coverage" (
+      "dataset" text, "c_id" integer, "resolution" text, "startdate" timestamp, "enddate" timestamp
+    )
+    RETURNS void AS $$
+    BEGIN
+      PERFORM pg_advisory_xact_lock(hashtext(concat_ws(':', "dataset", "c_id", "resolution")));
+      WITH "merged" AS (
+        DELETE FROM "fetch_coverage" AS f
+        WHERE f."dataset" = merge_coverage."dataset"
+          AND f."c_id" = merge_coverage."c_id"
+          AND f."resolution" = merge_coverage."resolution"
+          AND f."startdate" <= merge_coverage."enddate"
+          AND f."enddate" >= merge_coverage."startdate"
+        RETURNING f."startdate", f."enddate"
+      )
+      INSERT INTO "fetch_coverage" ("dataset", "c_id", "resolution", "startdate", "enddate")
+      SELECT merge_coverage."dataset", merge_coverage."c_id", merge_coverage."resolution",
+        least(min(m."startdate"), merge_coverage."startdate"), greatest(max(m."enddate"), merge_coverage."enddate")
+      FROM "merged" AS m;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS "watermarks" (
+      "dataset" varchar(32) NOT NULL,
+      "c_id" integer NOT NULL,
+      "resolution" varchar(2) NOT NULL,
+      "date" timestamp NOT NULL,
+      PRIMARY KEY ("dataset", "c_id", "resolution")
+    )
+    """
+]
+
+# Keyset paging orders undated rows by this expression.
+migrations += [
+    f"""CREATE INDEX IF NOT EXISTS "{table}_c_id_sort_date_id_idx" ON "{table}" """
+    f"""("c_id", (coalesce("date", '-infinity'::timestamp)), "id")"""
+    for table in (
+        "dividends", "earnings_calendars", "eps_estimates", "eps_surprises", "revenue_estimates",
+        "sec_sentiment", "sec_similarity", "splits", "trends", "upgrades_downgrades"
+    )
+]
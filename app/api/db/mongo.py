@@ -1,13 +1,21 @@
 import os
+import datetime
 import logging
 from typing import List
 from motor.motor_asyncio import AsyncIOMotorClient
 import pymongo
+from pymongo import IndexModel, UpdateOne
+from bson import ObjectId
+from bson.errors import InvalidId
+from .cursors import Page, decode_cursor
 
 logger = logging.getLogger()
 
 
 class MongoCrud(AsyncIOMotorClient):
+    statement_key = ("symbol", "period", "date")
+    press_release_key = ("symbol", "date", "headline")
+    watermark_key = ("dataset", "symbol")
 
     def __init__(self):
         super(MongoCrud, self).__init__(
@@ -21,6 +29,7 @@ class MongoCrud(AsyncIOMotorClient):
         )
 
         self.db = self[os.getenv("MONGO_DATABASE")]
+        self.stream_batch_size = int(os.getenv("MONGO_STREAM_BATCH_SIZE", "1000"))
 
         self.prs_collection = self.db.press_releases
         self.news_collection = self.db.company_news
@@ -30,120 +39,188 @@ class MongoCrud(AsyncIOMotorClient):
         self.is_collection = self.db.income_statements
         self.cf_collection = self.db.cash_flows
 
+        self.watermark_collection = self.db.watermarks
+
     def get_status(self):
         return {
             "connected": True,
             "threshold": self.local_threshold_ms
         }
 
+    async def ensure_indexes(self):
+        # Idempotent: creating an index that already exists with the same spec is a no-op.
+        by_symbol = IndexModel(
+            [("symbol", pymongo.ASCENDING), ("date", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+            name="symbol_date"
+        )
+        for collection in (self.news_collection, self.prs_collection):
+            await collection.create_indexes([by_symbol])
+
+        await self.finimize_collection.create_indexes([
+            IndexModel(
+                [("contentPieceType.identifier", pymongo.ASCENDING), ("date", pymongo.DESCENDING),
+                 ("_id", pymongo.DESCENDING)],
+                name="content_type_date"
+            ),
+            IndexModel([("date", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)], name="date")
+        ])
+
+        for collection in (self.bs_collection, self.is_collection, self.cf_collection):
+            await collection.create_indexes([by_symbol])
+            await self.create_unique_index(collection, self.statement_key)
+        await self.create_unique_index(self.prs_collection, self.press_release_key)
+        await self.create_unique_index(self.watermark_collection, self.watermark_key)
+
+    async def create_unique_index(self, collection, key: tuple):
+        # Natural keys of the upserts; documents duplicated before the index existed have to be cleaned up first.
+        try:
+            await collection.create_indexes([
+                IndexModel([(field, pymongo.ASCENDING) for field in key], name="_".join(key), unique=True)
+            ])
+        except pymongo.errors.DuplicateKeyError:
+            logger.warning(f"Duplicated {key} in `{collection.name}`, unique index is not created.")
+
     def change_id(self, doc):
         doc["_id"] = str(doc.pop("_id"))
         return doc
 
     # INSERT
+    async def upsert_many(self, collection, docs: List[dict], key: tuple):
+        # Insert-if-absent by natural key: documents already stored cost an index lookup instead of a failed write.
+        # The driver splits the operations into batches within the server's message and batch size limits.
+        if len(docs) == 0:
+            return
+        requests = [
+            UpdateOne(
+                dict((field, doc.get(field)) for field in key),
+                {"$setOnInsert": dict((field, value) for field, value in doc.items() if field not in key)},
+                upsert=True
+            )
+            for doc in docs
+        ]
+        await self.bulk_upsert(collection, requests)
+        await self.advance_watermarks(collection, docs)
+
+    async def bulk_upsert(self, collection, requests: list):
+        # Upserts by natural key only hit a duplicate key (11000) when a concurrent upsert of the same key won the
+        # race, and the document is then stored anyway. Any other write error is raised.
+        try:
+            await collection.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = [error for error in e.details["writeErrors"] if error["code"] != 11000]
+            if len(errors) != 0 or len(e.details.get("writeConcernErrors", [])) != 0:
+                raise
+            logger.info(f"{len(e.details['writeErrors'])} concurrent upserts were already stored. Skipping.")
+
+    async def advance_watermarks(self, collection, docs: List[dict]):
+        # Newest stored date per symbol, written right after the data. `$max` only ever moves it forward.
+        newest = {}
+        for doc in docs:
+            symbol, date = doc.get("symbol"), doc.get("date")
+            if symbol is None or not isinstance(date, datetime.datetime):
+                continue
+            if symbol not in newest or date > newest[symbol]:
+                newest[symbol] = date
+        if len(newest) == 0:
+            return
+        await self.bulk_upsert(self.watermark_collection, [
+            UpdateOne({"dataset": collection.name, "symbol": symbol}, {"$max": {"date": date}}, upsert=True)
+            for symbol, date in newest.items()
+        ])
+
     async def insert_company_news(self, docs: List[dict]):
-        async with await self.start_session() as s:
-            try:
-                await self.news_collection.insert_many(docs, ordered=False, session=s)
-            except pymongo.errors.BulkWriteError as e:
-                logger.info(f"{len(e.details['writeErrors'])} duplicates were found on insert. Skipping.")
+        await self.upsert_many(self.news_collection, docs, ("_id",))
 
     async def insert_press_releases(self, docs: List[dict]):
-        async with await self.start_session() as s:
-            try:
-                await self.prs_collection.insert_many(docs, ordered=False, session=s)
-            except pymongo.errors.BulkWriteError as e:
-                logger.info(f"{len(e.details['writeErrors'])} duplicates were found on insert. Skipping.")
+        await self.upsert_many(self.prs_collection, docs, self.press_release_key)
 
     async def insert_cash_flows(self, docs: List[dict]):
-        async with await self.start_session() as s:
-            try:
-                await self.cf_collection.insert_many(docs, ordered=False, session=s)
-            except pymongo.errors.BulkWriteError as e:
-                logger.info(f"{len(e.details['writeErrors'])} duplicates were found on insert. Skipping.")
+        await self.upsert_many(self.cf_collection, docs, self.statement_key)
 
     async def insert_income_statements(self, docs: List[dict]):
-        async with await self.start_session() as s:
-            try:
-                await self.is_collection.insert_many(docs, ordered=False, session=s)
-            except pymongo.errors.BulkWriteError as e:
-                logger.info(f"{len(e.details['writeErrors'])} duplicates were found on insert. Skipping.")
+        await self.upsert_many(self.is_collection, docs, self.statement_key)
 
     async def insert_balance_sheets(self, docs: List[dict]):
-        async with await self.start_session() as s:
-            try:
-                await self.bs_collection.insert_many(docs, ordered=False, session=s)
-            except pymongo.errors.BulkWriteError as e:
-                logger.info(f"{len(e.details['writeErrors'])} duplicates were found on insert. Skipping.")
+        await self.upsert_many(self.bs_collection, docs, self.statement_key)
 
     async def insert_finimize_news(self, docs: List[dict]):
-        async with await self.start_session() as s:
-            try:
-                await self.finimize_collection.insert_many(docs, ordered=False, session=s)
-            except pymongo.errors.BulkWriteError as e:
-                logger.info(f"{len(e.details['writeErrors'])} duplicates were found on insert. Skipping.")
+        await self.upsert_many(self.finimize_collection, docs, ("_id",))
 
     # RETRIEVE
-    async def get_company_news(self, symbol: str, limit: int = 10, offset: int = 0):
-        result = await (
-            self.news_collection
-            .find({"symbol": symbol})
-            .sort("date", pymongo.DESCENDING)
-            .skip(offset).limit(limit)
-            .to_list(length=limit)
-        )
-        return [self.change_id(res) for res in result]
-
-    async def get_press_releases(self, symbol: str, limit: int = 10, offset: int = 0):
-        result = await (
-            self.prs_collection
-            .find({"symbol": symbol})
-            .sort("date", pymongo.DESCENDING)
-            .skip(offset).limit(limit)
-            .to_list(length=limit)
-        )
-        return [self.change_id(res) for res in result]
-
-    async def get_cash_flows(self, symbol: str = None, limit: int = 10, offset: int = 0):
-        result = await (
-            self.cf_collection
-            .find({"symbol": symbol})
-            .sort("date", pymongo.DESCENDING)
-            .skip(offset).limit(limit)
-            .to_list(length=limit)
-        )
-        return [self.change_id(res) for res in result]
-
-    async def get_income_statements(self, symbol: str = None, limit: int = 10, offset: int = 0):
-        result = await (
-            self.is_collection
-            .find({"symbol": symbol})
-            .sort("date", pymongo.DESCENDING)
+    async def iterate_documents(self, documents):
+        async for document in documents:
+            yield self.change_id(document)
+
+    async def find_page(
+        self, collection, query: dict, limit: int, offset: int, cursor: str,
+        stream: bool = False, id_type=ObjectId
+    ):
+        # Keyset pagination on (date, _id). The cursor carries the id as a string, `id_type` restores the stored
+        # type: Finnhub's integer ids for news, Finimize's own string ids.
+        if cursor is not None:
+            date, _id = decode_cursor(cursor)
+            try:
+                _id = id_type(_id)
+            except (TypeError, ValueError, InvalidId) as e:
+                raise ValueError(f"Invalid cursor `{cursor}`.") from e
+            if date is None:
+                # Documents without a date sort last in descending order.
+                query = {**query, "date": None, "_id": {"$lt": _id}}
+            else:
+                query = {
+                    **query,
+                    "$or": [{"date": {"$lt": date}}, {"date": date, "_id": {"$lt": _id}}, {"date": None}]
+                }
+        documents = (
+            collection
+            .find(query)
+            .sort([("date", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
             .skip(offset).limit(limit)
-            .to_list(length=limit)
         )
-        return [self.change_id(res) for res in result]
-
-    async def get_balance_sheets(self, symbol: str = None, limit: int = 10, offset: int = 0):
-        result = await (
-            self.bs_collection
-            .find({"symbol": symbol})
-            .sort("date", pymongo.DESCENDING)
-            .skip(offset).limit(limit)
-            .to_list(length=limit)
+        if stream:
+            return self.iterate_documents(documents.batch_size(self.stream_batch_size))
+        result = await documents.to_list(length=limit)
+        return Page([self.change_id(res) for res in result], limit, key="_id")
+
+    async def get_watermark(self, dataset: str, symbol: str):
+        doc = await self.watermark_collection.find_one({"dataset": dataset, "symbol": symbol})
+        if doc is None:
+            return None
+        # Stored as UTC; the Finnhub dates it is compared with are naive.
+        return doc["date"].replace(tzinfo=None)
+
+    async def get_company_news(
+        self, symbol: str, limit: int = 10, offset: int = 0, cursor: str = None, stream: bool = False
+    ):
+        return await self.find_page(
+            self.news_collection, {"symbol": symbol}, limit, offset, cursor, stream, id_type=int
         )
-        return [self.change_id(res) for res in result]
 
-    async def get_finimize_news(self, content_type: str = None, limit: int = 10, offset: int = 0):
+    async def get_press_releases(
+        self, symbol: str, limit: int = 10, offset: int = 0, cursor: str = None, stream: bool = False
+    ):
+        return await self.find_page(self.prs_collection, {"symbol": symbol}, limit, offset, cursor, stream)
+
+    async def get_cash_flows(
+        self, symbol: str = None, limit: int = 10, offset: int = 0, cursor: str = None, stream: bool = False
+    ):
+        return await self.find_page(self.cf_collection, {"symbol": symbol}, limit, offset, cursor, stream)
+
+    async def get_income_statements(
+        self, symbol: str = None, limit: int = 10, offset: int = 0, cursor: str = None, stream: bool = False
+    ):
+        return await self.find_page(self.is_collection, {"symbol": symbol}, limit, offset, cursor, stream)
+
+    async def get_balance_sheets(
+        self, symbol: str = None, limit: int = 10, offset: int = 0, cursor: str = None, stream: bool = False
+    ):
+        return await self.find_page(self.bs_collection, {"symbol": symbol}, limit, offset, cursor, stream)
+
+    async def get_finimize_news(
+        self, content_type: str = None, limit: int = 10, offset: int = 0, cursor: str = None, stream: bool = False
+    ):
         query = {}
         if content_type is not None:
             query = {"contentPieceType.identifier": content_type}
 
-        result = await (
-            self.finimize_collection
-            .find(query)
-            .sort("date", pymongo.DESCENDING)
-            .skip(offset).limit(limit)
-            .to_list(length=limit)
-        )
-        return [self.change_id(res) for res in result]
+        return await self.find_page(self.finimize_collection, query, limit, offset, cursor, stream, id_type=str)
@@ -1,7 +1,8 @@
 from sqlalchemy import (
-    BigInteger, Column, DateTime, Float, ForeignKey, Index,
-    Integer, MetaData, String, Table, Text, text
+    BigInteger, Column, Date, DateTime, Float, ForeignKey, Index,
+    Integer, MetaData, String, Table, Text, func, literal_column, text
 )
+from sqlalchemy.dialects.postgresql import ARRAY, DOUBLE_PRECISION
 
 metadata = MetaData()
 
@@ -46,14 +47,28 @@ crypto_candles = Table(
     'crypto_candles', metadata,
     Column('id', Integer, primary_key=True, server_default=text("nextval('crypto_candles_id_seq'::regclass)")),
     Column('c_id', ForeignKey('crypto.id'), nullable=False),
-    Column('date', DateTime, nullable=True),
+    Column('date', DateTime, primary_key=True, nullable=False),
     Column('open', Float, nullable=False),
     Column('high', Float, nullable=False),
     Column('low', Float, nullable=False),
     Column('close', Float, nullable=False),
     Column('volume', BigInteger, nullable=False),
     Column('resolution', String(2), nullable=False),
-    Index('crypto_candles_c_id_date_resolution_idx', 'c_id', 'date', 'resolution', unique=True)
+    Index('crypto_candles_c_id_date_resolution_idx', 'c_id', 'date', 'resolution', unique=True),
+    postgresql_partition_by='RANGE (date)'
+)
+
+crypto_candles_packed = Table(
+    'crypto_candles_packed', metadata,
+    Column('c_id', ForeignKey('crypto.id'), primary_key=True, nullable=False),
+    Column('resolution', String(2), primary_key=True, nullable=False),
+    Column('day', Date, primary_key=True, nullable=False),
+    Column('time', ARRAY(Integer), nullable=False),
+    Column('open', ARRAY(DOUBLE_PRECISION), nullable=False),
+    Column('high', ARRAY(DOUBLE_PRECISION), nullable=False),
+    Column('low', ARRAY(DOUBLE_PRECISION), nullable=False),
+    Column('close', ARRAY(DOUBLE_PRECISION), nullable=False),
+    Column('volume', ARRAY(BigInteger), nullable=False)
 )
 
 
@@ -112,6 +127,16 @@ eps_surprises = Table(
 )
 
 
+fetch_coverage = Table(
+    'fetch_coverage', metadata,
+    Column('dataset', String(32), primary_key=True, nullable=False),
+    Column('c_id', Integer, primary_key=True, nullable=False),
+    Column('resolution', String(2), primary_key=True, nullable=False),
+    Column('startdate', DateTime, primary_key=True, nullable=False),
+    Column('enddate', DateTime, nullable=False)
+)
+
+
 revenue_estimates = Table(
     'revenue_estimates', metadata,
     Column('id', Integer, primary_key=True, server_default=text("nextval('revenue_estimates_id_seq'::regclass)")),
@@ -177,14 +202,28 @@ stocks_candles = Table(
     'stocks_candles', metadata,
     Column('id', Integer, primary_key=True, server_default=text("nextval('stocks_candles_id_seq'::regclass)")),
     Column('c_id', ForeignKey('companies.id'), nullable=False),
-    Column('date', DateTime, nullable=True),
+    Column('date', DateTime, primary_key=True, nullable=False),
     Column('open', Float, nullable=False),
     Column('high', Float, nullable=False),
     Column('low', Float, nullable=False),
     Column('close', Float, nullable=False),
     Column('volume', BigInteger, nullable=False),
     Column('resolution', String(2), nullable=False),
-    Index('stocks_candles_c_id_date_resolution_idx', 'c_id', 'date', 'resolution', unique=True)
+    Index('stocks_candles_c_id_date_resolution_idx', 'c_id', 'date', 'resolution', unique=True),
+    postgresql_partition_by='RANGE (date)'
+)
+
+stocks_candles_packed = Table(
+    'stocks_candles_packed', metadata,
+    Column('c_id', ForeignKey('companies.id'), primary_key=True, nullable=False),
+    Column('resolution', String(2), primary_key=True, nullable=False),
+    Column('day', Date, primary_key=True, nullable=False),
+    Column('time', ARRAY(Integer), nullable=False),
+    Column('open', ARRAY(DOUBLE_PRECISION), nullable=False),
+    Column('high', ARRAY(DOUBLE_PRECISION), nullable=False),
+    Column('low', ARRAY(DOUBLE_PRECISION), nullable=False),
+    Column('close', ARRAY(DOUBLE_PRECISION), nullable=False),
+    Column('volume', ARRAY(BigInteger), nullable=False)
 )
 
 
@@ -213,3 +252,23 @@ upgrades_downgrades = Table(
     Column('action', String(64), nullable=False),
     Index('upgrades_downgrades_c_id_date_idx', 'c_id', 'date', unique=True)
 )
+
+
+watermarks = Table(
+    'watermarks', metadata,
+    Column('dataset', String(32), primary_key=True, nullable=False),
+    Column('c_id', Integer, primary_key=True, nullable=False),
+    Column('resolution', String(2), primary_key=True, nullable=False),
+    Column('date', DateTime, nullable=False)
+)
+
+
+# Keyset pagination order of the tables with a nullable date: rows without a date sort after the dated ones.
+for table in (
+    dividends, earnings_calendars, eps_estimates, eps_surprises, revenue_estimates,
+    sec_sentiment, sec_similarity, splits, trends, upgrades_downgrades
+):
+    Index(
+        f"{table.name}_c_id_sort_date_id_idx",
+        table.c.c_id, func.coalesce(table.c.date, literal_column("'-infinity'::timestamp")), table.c.id
+    )
@@ -1,17 +1,52 @@
 import os
+import datetime
 from typing import List
 from databases import Database
-from sqlalchemy import desc, and_
+from sqlalchemy import (
+    BigInteger, Date, DateTime, Float, Integer, String, Table, text, select, desc, and_, tuple_, func, literal_column
+)
 from sqlalchemy.dialects.postgresql import insert
+from .cursors import Page, decode_cursor
+from .migrations import migrations
 from .pg_tables import (
     companies, dividends, sec_sentiment, sec_similarity,
     stocks_candles, splits,
     trends, eps_estimates, eps_surprises, upgrades_downgrades, revenue_estimates, earnings_calendars,
-    crypto, crypto_candles
+    crypto, crypto_candles, stocks_candles_packed, crypto_candles_packed, fetch_coverage, watermarks
 )
 
+packed_tables = {
+    stocks_candles.name: stocks_candles_packed,
+    crypto_candles.name: crypto_candles_packed
+}
+
+# Packed per-day arrays unnested back into one candle per row, with the columns of the candle tables except `id`.
+packed_candles_query = """
+    SELECT p.c_id, p.resolution, p.day, p.day + make_interval(secs => t.time) AS date,
+        t.open, t.high, t.low, t.close, t.volume
+    FROM "{packed}" AS p
+    CROSS JOIN LATERAL unnest(p.time, p.open, p.high, p.low, p.close, p.volume)
+        AS t (time, open, high, low, close, volume)
+"""
+
+
+# Sort key of rows without a date, the same expression as in the keyset indexes.
+undated = literal_column("'-infinity'::timestamp")
+
+# Newest stored date per (dataset, c_id, resolution), only ever moved forward.
+# `{source}` yields (c_id, resolution, date) rows.
+watermark_query = """
+    INSERT INTO "watermarks" AS w ("dataset", "c_id", "resolution", "date")
+    SELECT $1::varchar, s.c_id, s.resolution, max(s.date)
+    FROM ({source}) AS s (c_id, resolution, date)
+    WHERE s.date IS NOT NULL
+    GROUP BY s.c_id, s.resolution
+    ON CONFLICT ("dataset", "c_id", "resolution") DO UPDATE SET "date" = GREATEST(w."date", EXCLUDED."date")
+"""
+
 
 class PgCrud(Database):
+    candle_fields = ("open", "high", "low", "close", "volume")
 
     def __init__(self):
         self.database_url = (
@@ -25,6 +60,46 @@ class PgCrud(Database):
 
         super(PgCrud, self).__init__(self.database_url, min_size=min_size, max_size=max_size)
 
+        # symbol -> profile row for `companies` and `crypto`, filled at connect and on first miss.
+        self.profiles = {companies.name: {}, crypto.name: {}}
+        # (table, year, month) of candle partitions known to exist.
+        self.partitions = set()
+        # Candle tables partitioned by month; databases created before partitioning keep plain tables.
+        self.partitioned = set()
+        # Resolutions stored one row per (c_id, resolution, day) in the `*_packed` tables.
+        self.packed_resolutions = set(filter(None, os.getenv("PG_PACKED_RESOLUTIONS", "").split(",")))
+
+    async def connect(self):
+        await super(PgCrud, self).connect()
+        await self.migrate()
+        await self.warm_profiles()
+
+    async def migrate(self):
+        # API and workers start concurrently, the lock keeps them from racing on the same objects.
+        async with self.transaction():
+            async with self.connection() as connection:
+                await connection.raw_connection.execute("SELECT pg_advisory_xact_lock(hashtext('migrations'))")
+                for migration in migrations:
+                    await connection.raw_connection.execute(migration)
+        rows = await self.fetch_all(
+            "SELECT c.relname FROM pg_partitioned_table AS p JOIN pg_class AS c ON c.oid = p.partrelid"
+        )
+        self.partitioned = set(row["relname"] for row in rows)
+
+    async def warm_profiles(self):
+        for table in (companies, crypto):
+            rows = await self.fetch_all(table.select())
+            self.profiles[table.name] = dict((row["symbol"], dict(row)) for row in rows)
+
+    async def get_profile(self, table: Table, symbol: str):
+        profile = self.profiles[table.name].get(symbol)
+        if profile is None:
+            row = await self.fetch_one(table.select(whereclause=(table.c.symbol == symbol)))
+            if row is None:
+                return row
+            profile = self.profiles[table.name][symbol] = dict(row)
+        return dict(profile)
+
     def get_status(self):
         return {
             "connected": self.is_connected
@@ -34,229 +109,410 @@ class PgCrud(Database):
         return [dict(v) for v in values]
 
     # INSERT VALUES
+    async def copy_insert(self, table: Table, columns: List[str], records):
+        # Binary COPY into a staging table, then a single set-based merge into the target. The staging table is
+        # created once per connection with all the columns of the target and emptied on every commit, so inserts
+        # do not churn the system catalogs.
+        staging = f"{table.name}_staging"
+        names = ", ".join(f'"{name}"' for name in columns)
+        async with self.transaction():
+            async with self.connection() as connection:
+                raw_connection = connection.raw_connection
+                await raw_connection.execute(
+                    f'CREATE TEMPORARY TABLE IF NOT EXISTS "{staging}" ON COMMIT DELETE ROWS AS '
+                    f'SELECT * FROM "{table.name}" WITH NO DATA'
+                )
+                await raw_connection.copy_records_to_table(staging, records=records, columns=columns)
+                await raw_connection.execute(
+                    f'INSERT INTO "{table.name}" ({names}) SELECT {names} FROM "{staging}" ON CONFLICT DO NOTHING'
+                )
+                if "c_id" in columns and "date" in columns:
+                    resolution = '"resolution"' if "resolution" in columns else "''"
+                    await raw_connection.execute(
+                        watermark_query.format(source=f'SELECT "c_id", {resolution}, "date" FROM "{staging}"'),
+                        table.name
+                    )
+
+    async def bulk_insert(self, table: Table, values: List[dict]):
+        if len(values) == 0:
+            return
+        columns = [column.name for column in table.columns if column.name in values[0]]
+        await self.copy_insert(table, columns, [tuple(value.get(name) for name in columns) for value in values])
+
     async def insert_company(self, values: dict):
         async with self.transaction():
             query = insert(companies).on_conflict_do_nothing()
             c_id = await self.execute(query, values)
+        self.profiles[companies.name].pop(values["symbol"], None)
         return c_id
 
     async def insert_dividends(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(dividends).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(dividends, values)
 
     async def insert_sec_sentiment(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(sec_sentiment).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(sec_sentiment, values)
 
     async def insert_sec_similarity(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(sec_similarity).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(sec_similarity, values)
 
-    async def insert_stock_candles(self, values: List[dict]):
+    async def ensure_partitions(self, table: Table, startdate: datetime.datetime, enddate: datetime.datetime):
+        months = set(
+            (table.name, month // 12, month % 12 + 1)
+            for month in range(startdate.year * 12 + startdate.month - 1, enddate.year * 12 + enddate.month)
+        )
+        if table.name not in self.partitioned or months <= self.partitions:
+            return
+        # Own short transaction: the function serializes partition creation per table with an advisory lock.
+        await self.execute(
+            query="SELECT create_monthly_partitions(:parent, :startdate, :enddate)",
+            values={"parent": table.name, "startdate": startdate, "enddate": enddate}
+        )
+        self.partitions |= months
+
+    async def insert_packed_candles(self, table: Table, batch):
+        # Bars are grouped into one row per day. An existing day is merged by time, keeping the stored bar on a tie.
+        packed = packed_tables[table.name]
+        aggregates = ", ".join(f"array_agg(t.{name} ORDER BY t.time)" for name in ("time",) + self.candle_fields)
+        merged = ", ".join(f"array_agg(m.{name} ORDER BY m.time)" for name in ("time",) + self.candle_fields)
+        query = f"""
+            INSERT INTO "{packed.name}" AS p
+                ("c_id", "resolution", "day", "time", "open", "high", "low", "close", "volume")
+            SELECT $1::integer, $2::varchar, t.day, {aggregates}
+            FROM unnest($3::date[], $4::integer[], $5::float8[], $6::float8[], $7::float8[], $8::float8[], $9::bigint[])
+                AS t (day, time, open, high, low, close, volume)
+            GROUP BY t.day
+            ON CONFLICT ("c_id", "resolution", "day") DO UPDATE SET
+                ("time", "open", "high", "low", "close", "volume") = (
+                    SELECT {merged}
+                    FROM (
+                        SELECT DISTINCT ON (u.time) u.* FROM (
+                            SELECT a.*, 0 AS source
+                            FROM unnest(p.time, p.open, p.high, p.low, p.close, p.volume)
+                                AS a (time, open, high, low, close, volume)
+                            UNION ALL
+                            SELECT b.*, 1 AS source
+                            FROM unnest(EXCLUDED.time, EXCLUDED.open, EXCLUDED.high,
+                                EXCLUDED.low, EXCLUDED.close, EXCLUDED.volume)
+                                AS b (time, open, high, low, close, volume)
+                        ) AS u
+                        ORDER BY u.time, u.source
+                    ) AS m
+                )
+        """
+        days, seconds = batch.day_offsets()
         async with self.transaction():
-            query = insert(stocks_candles).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+            async with self.connection() as connection:
+                await connection.raw_connection.execute(
+                    query, batch.constants["c_id"], batch.constants["resolution"],
+                    days, seconds, *batch.arrays(list(self.candle_fields))
+                )
+                await connection.raw_connection.execute(
+                    watermark_query.format(source="SELECT $2::integer, $3::varchar, $4::timestamp"),
+                    table.name, batch.constants["c_id"], batch.constants["resolution"], batch.max_date()
+                )
+
+    async def insert_candles(self, table: Table, batch):
+        if len(batch) == 0:
+            return
+        if batch.constants["resolution"] in self.packed_resolutions:
+            return await self.insert_packed_candles(table, batch)
+        await self.ensure_partitions(table, batch.min_date(), batch.max_date())
+        columns = [column.name for column in table.columns if column.server_default is None]
+        await self.copy_insert(table, columns, batch.records(columns))
+
+    async def insert_stock_candles(self, values):
+        await self.insert_candles(stocks_candles, values)
 
     async def insert_splits(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(splits).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(splits, values)
 
     async def insert_trends(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(trends).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(trends, values)
 
     async def insert_eps_estimates(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(eps_estimates).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(eps_estimates, values)
 
     async def insert_eps_surprises(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(eps_surprises).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(eps_surprises, values)
 
     async def insert_upgrades_downgrades(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(upgrades_downgrades).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(upgrades_downgrades, values)
 
     async def insert_revenue_estimates(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(revenue_estimates).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(revenue_estimates, values)
 
     async def insert_earnings_calendars(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(earnings_calendars).on_conflict_do_nothing()
-            await self.execute_many(query, values)
+        await self.bulk_insert(earnings_calendars, values)
 
     async def insert_crypto(self, values: dict):
         async with self.transaction():
             query = insert(crypto).on_conflict_do_nothing()
             c_id = await self.execute(query, values)
+        self.profiles[crypto.name].pop(values["symbol"], None)
         return c_id
 
-    async def insert_crypto_candles(self, values: List[dict]):
-        async with self.transaction():
-            query = insert(crypto_candles).on_conflict_do_update()
-            await self.execute_many(query, values)
+    async def insert_crypto_candles(self, values):
+        await self.insert_candles(crypto_candles, values)
+
+    async def insert_coverage(
+        self, dataset: str, c_id: int, resolution: str, startdate: datetime.datetime, enddate: datetime.datetime
+    ):
+        # Merged with the overlapping and adjacent intervals, so each key keeps a few disjoint rows.
+        await self.execute(
+            query="SELECT merge_coverage(:dataset, :c_id, :resolution, :startdate, :enddate)",
+            values={
+                "dataset": dataset, "c_id": c_id, "resolution": resolution,
+                "startdate": startdate, "enddate": enddate
+            }
+        )
 
     # GET VALUES
-    async def get_company(self, symbol: str):
-        query = companies.select(
-            whereclause=(companies.c.symbol == symbol)
+    def coverage_clause(self, dataset: str, c_id: int, resolution: str):
+        return and_(
+            fetch_coverage.c.dataset == dataset,
+            fetch_coverage.c.c_id == c_id,
+            fetch_coverage.c.resolution == resolution
         )
-        row = await self.fetch_one(query)
-        if row is not None:
-            return dict(row)
-        return row
+
+    async def get_coverage(
+        self, dataset: str, c_id: int, resolution: str, startdate: datetime.datetime, enddate: datetime.datetime
+    ):
+        query = fetch_coverage.select(whereclause=and_(
+            self.coverage_clause(dataset, c_id, resolution),
+            fetch_coverage.c.startdate <= enddate,
+            fetch_coverage.c.enddate >= startdate
+        )).order_by(fetch_coverage.c.startdate)
+        rows = await self.fetch_all(query)
+        return self.mappings_to_dicts(rows)
+
+    async def get_watermark(self, dataset: str, c_id: int, resolution: str = ""):
+        query = select([watermarks.c.date]).where(and_(
+            watermarks.c.dataset == dataset,
+            watermarks.c.c_id == c_id,
+            watermarks.c.resolution == resolution
+        ))
+        return await self.fetch_val(query)
+
+    async def get_covered_until(self, dataset: str, c_id: int, resolution: str):
+        query = select([func.max(fetch_coverage.c.enddate)]).where(self.coverage_clause(dataset, c_id, resolution))
+        return await self.fetch_val(query)
+
+    def candle_source(self, table: Table, resolution: str):
+        if resolution not in self.packed_resolutions:
+            return table
+        query = text(packed_candles_query.format(packed=packed_tables[table.name].name))
+        return query.columns(
+            c_id=Integer, resolution=String, day=Date, date=DateTime,
+            open=Float, high=Float, low=Float, close=Float, volume=BigInteger
+        ).alias(table.name)
+
+    async def fetch_page(
+        self, table: Table, whereclause, limit: int, offset: int, cursor: str, stream: bool = False
+    ):
+        # Keyset pagination on (date, id): `date <= ...` keeps the scan on the (c_id, date, ...) index.
+        # Packed candles have no `id` but are unique per date, and are ordered by day first to follow their index.
+        packed = "day" in table.c
+        if packed:
+            order_by = [desc(table.c.day), desc(table.c.date)]
+        else:
+            order_by = [desc(self.sort_date(table)), desc(table.c.id)]
+        if cursor is not None:
+            date, _id = decode_cursor(cursor)
+            if packed:
+                if date is None:
+                    raise ValueError(f"Invalid cursor `{cursor}`.")
+                whereclause = and_(whereclause, table.c.day <= date.date(), table.c.date < date)
+            else:
+                date = undated if date is None else date
+                whereclause = and_(
+                    whereclause, self.sort_date(table) <= date,
+                    tuple_(self.sort_date(table), table.c.id) < tuple_(date, _id)
+                )
+        query = table.select(whereclause=whereclause, order_by=order_by, limit=limit, offset=offset)
+        if stream:
+            return self.iterate_dicts(query)
+        rows = await self.fetch_all(query=query)
+        return Page(self.mappings_to_dicts(rows), limit)
+
+    def sort_date(self, table: Table):
+        # Rows without a date sort after the dated ones, on the (c_id, coalesce(date, ...), id) index.
+        if table.c.date.nullable:
+            return func.coalesce(table.c.date, undated)
+        return table.c.date
+
+    async def iterate_dicts(self, query):
+        # Server-side cursor: rows are fetched in small batches while the response is being sent.
+        async for row in self.iterate(query=query):
+            yield dict(row)
+
+    async def get_company(self, symbol: str):
+        return await self.get_profile(companies, symbol)
 
     async def get_companies(self):
         query = companies.select()
         rows = await self.fetch_all(query)
         return self.mappings_to_dicts(rows)
 
-    async def get_dividends(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_dividends(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = dividends.select(
-            whereclause=(dividends.c.c_id == _id),
-            order_by=desc(dividends.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        return await self.fetch_page(dividends, dividends.c.c_id == _id, limit, offset, cursor, stream)
 
-    async def get_sec_sentiments(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_sec_sentiments(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = sec_sentiment.select(
-            whereclause=(sec_sentiment.c.c_id == _id),
-            order_by=desc(sec_sentiment.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        return await self.fetch_page(sec_sentiment, sec_sentiment.c.c_id == _id, limit, offset, cursor, stream)
 
-    async def get_sec_similarities(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_sec_similarities(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = sec_similarity.select(
-            whereclause=(sec_similarity.c.c_id == _id),
-            order_by=desc(sec_similarity.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        return await self.fetch_page(sec_similarity, sec_similarity.c.c_id == _id, limit, offset, cursor, stream)
 
-    async def get_stock_candles(self, symbol: str, resolution: str, limit: int = 100, offset: int = None):
+    async def get_stock_candles(
+        self, symbol: str, resolution: str,
+        limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = stocks_candles.select(
-            whereclause=and_(
-                stocks_candles.c.c_id == _id,
-                stocks_candles.c.resolution == resolution
-            ),
-            order_by=desc(stocks_candles.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        source = self.candle_source(stocks_candles, resolution)
+        whereclause = and_(source.c.c_id == _id, source.c.resolution == resolution)
+        return await self.fetch_page(source, whereclause, limit, offset, cursor, stream)
 
-    async def get_splits(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_splits(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = splits.select(
-            whereclause=(splits.c.c_id == _id),
-            order_by=desc(splits.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        return await self.fetch_page(splits, splits.c.c_id == _id, limit, offset, cursor, stream)
 
-    async def get_trends(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_trends(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = trends.select(
-            whereclause=(trends.c.c_id == _id),
-            order_by=desc(trends.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        return await self.fetch_page(trends, trends.c.c_id == _id, limit, offset, cursor, stream)
 
-    async def get_eps_estimates(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_eps_estimates(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = eps_estimates.select(
-            whereclause=(eps_estimates.c.c_id == _id),
-            order_by=desc(eps_estimates.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        return await self.fetch_page(eps_estimates, eps_estimates.c.c_id == _id, limit, offset, cursor, stream)
 
-    async def get_eps_surprises(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_eps_surprises(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = eps_surprises.select(
-            whereclause=(eps_surprises.c.c_id == _id),
-            order_by=desc(eps_surprises.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        return await self.fetch_page(eps_surprises, eps_surprises.c.c_id == _id, limit, offset, cursor, stream)
 
-    async def get_upgrades_downgrades(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_upgrades_downgrades(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = upgrades_downgrades.select(
-            whereclause=(upgrades_downgrades.c.c_id == _id),
-            order_by=desc(upgrades_downgrades.c.date),
-            limit=limit, offset=offset
+        return await self.fetch_page(
+            upgrades_downgrades, upgrades_downgrades.c.c_id == _id, limit, offset, cursor, stream
         )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
 
-    async def get_revenue_estimates(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_revenue_estimates(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = revenue_estimates.select(
-            whereclause=(revenue_estimates.c.c_id == _id),
-            order_by=desc(revenue_estimates.c.date),
-            limit=limit, offset=offset
-        )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        return await self.fetch_page(revenue_estimates, revenue_estimates.c.c_id == _id, limit, offset, cursor, stream)
 
-    async def get_earnings_calendars(self, symbol: str, limit: int = 100, offset: int = None):
+    async def get_earnings_calendars(
+        self, symbol: str, limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
         _id = (await self.get_company(symbol))["id"]
-        query = earnings_calendars.select(
-            whereclause=(earnings_calendars.c.c_id == _id),
-            order_by=desc(earnings_calendars.c.date),
-            limit=limit, offset=offset
+        return await self.fetch_page(
+            earnings_calendars, earnings_calendars.c.c_id == _id, limit, offset, cursor, stream
         )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
 
     async def get_crypto(self, symbol: str):
-        query = crypto.select(
-            whereclause=(crypto.c.symbol == symbol)
-        )
-        row = await self.fetch_one(query)
-        if row is not None:
-            return dict(row)
-        return row
+        return await self.get_profile(crypto, symbol)
 
     async def get_cryptos(self):
         query = crypto.select()
         rows = await self.fetch_all(query)
         return self.mappings_to_dicts(rows)
 
-    async def get_crypto_candles(self, symbol: str, resolution: str, limit: int = 100, offset: int = None):
-        _id = (await self.get_company(symbol))["id"]
-        query = crypto_candles.select(
-            whereclause=and_(
-                crypto_candles.c.c_id == _id,
-                crypto_candles.c.resolution == resolution
-            ),
-            order_by=desc(crypto_candles.c.date),
-            limit=limit, offset=offset
+    async def get_crypto_candles(
+        self, symbol: str, resolution: str,
+        limit: int = 100, offset: int = None, cursor: str = None, stream: bool = False
+    ):
+        _id = (await self.get_crypto(symbol))["id"]
+        source = self.candle_source(crypto_candles, resolution)
+        whereclause = and_(source.c.c_id == _id, source.c.resolution == resolution)
+        return await self.fetch_page(source, whereclause, limit, offset, cursor, stream)
+
+    async def iterate_candles(
+        self, table: Table, ids: List[int], resolution: str, columns: List[str],
+        startdate: datetime.datetime = None, enddate: datetime.datetime = None
+    ):
+        # Oldest first, one symbol after another, so exported series come out ready to use.
+        source = self.candle_source(table, resolution)
+        whereclause = and_(source.c.c_id.in_(ids), source.c.resolution == resolution)
+        if startdate is not None:
+            whereclause = and_(whereclause, source.c.date >= startdate)
+        if enddate is not None:
+            whereclause = and_(whereclause, source.c.date <= enddate)
+        order_by = [source.c.c_id, source.c.day, source.c.date] if source is not table else [table.c.c_id, table.c.date]
+        query = select(
+            [source.c[name] for name in columns],
+            whereclause=whereclause,
+            order_by=order_by
         )
-        rows = await self.fetch_all(query=query)
-        return self.mappings_to_dicts(rows)
+        async for row in self.iterate(query=query):
+            yield row
+
+    async def candle_panel(
+        self, table: Table, ids: List[int], resolution: str, limit: int = 1000, fill: bool = True,
+        startdate: datetime.datetime = None, enddate: datetime.datetime = None
+    ):
+        # One row per (date, c_id) over the union of the symbols' timestamps. `grp` counts the real bars seen so far,
+        # so a missing bar shares its group with the last real one and, with `fill`, becomes a flat bar at its close.
+        conditions = ["c_id = ANY(:ids)", "resolution = :resolution"]
+        values = {"ids": ids, "resolution": resolution, "limit": limit, "fill": fill}
+        if startdate is not None:
+            conditions.append("date >= :startdate")
+            values["startdate"] = startdate
+        if enddate is not None:
+            conditions.append("date <= :enddate")
+            values["enddate"] = enddate
+        source = f'"{table.name}"'
+        if resolution in self.packed_resolutions:
+            source = f"({packed_candles_query.format(packed=packed_tables[table.name].name)})"
+        query = f"""
+            WITH grid AS (
+                SELECT DISTINCT date FROM {source} AS c
+                WHERE {" AND ".join(conditions)}
+                ORDER BY date DESC LIMIT :limit
+            ), panel AS (
+                SELECT grid.date, ids.c_id, t.open, t.high, t.low, t.close, t.volume,
+                    count(t.close) OVER (PARTITION BY ids.c_id ORDER BY grid.date) AS grp
+                FROM grid CROSS JOIN unnest(CAST(:ids AS integer[])) AS ids (c_id)
+                LEFT JOIN {source} AS t
+                    ON t.c_id = ids.c_id AND t.date = grid.date AND t.resolution = :resolution
+            )
+            SELECT date, c_id,
+                CASE WHEN close IS NULL AND :fill THEN last_close ELSE open END AS open,
+                CASE WHEN close IS NULL AND :fill THEN last_close ELSE high END AS high,
+                CASE WHEN close IS NULL AND :fill THEN last_close ELSE low END AS low,
+                CASE WHEN close IS NULL AND :fill THEN last_close ELSE close END AS close,
+                CASE WHEN close IS NULL AND :fill AND last_close IS NOT NULL THEN 0 ELSE volume END AS volume
+            FROM (
+                SELECT *, first_value(close) OVER (PARTITION BY c_id, grp ORDER BY date) AS last_close FROM panel
+            ) AS filled
+            ORDER BY date, c_id
+        """
+        rows = await self.fetch_all(query=query, values=values)
+
+        fields = self.candle_fields
+        panel = {"dates": [], **dict((field, []) for field in fields)}
+        positions = dict((_id, i) for i, _id in enumerate(ids))
+        for row in rows:
+            if len(panel["dates"]) == 0 or panel["dates"][-1] != row["date"]:
+                panel["dates"].append(row["date"])
+                for field in fields:
+                    panel[field].append([None] * len(ids))
+            for field in fields:
+                panel[field][-1][positions[row["c_id"]]] = row[field]
+        return panel
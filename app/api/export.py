@@ -0,0 +1,148 @@
+import sys
+import asyncio
+import argparse
+import datetime
+from typing import List
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from db import pg_db
+from db.pg_tables import stocks_candles, crypto_candles
+
+candle_tables = {
+    "stock": stocks_candles,
+    "crypto": crypto_candles
+}
+
+candle_fields = {
+    "symbol": pa.string(),
+    "date": pa.timestamp("us"),
+    "open": pa.float64(),
+    "high": pa.float64(),
+    "low": pa.float64(),
+    "close": pa.float64(),
+    "volume": pa.int64()
+}
+
+media_types = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+
+class ChunkSink():
+    # Write-only file object: writers append to it and every drain() hands the bytes written so far to the response.
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def candle_schema(columns: List[str] = None) -> pa.Schema:
+    columns = columns or list(candle_fields)
+    unknown = set(columns) - set(candle_fields)
+    if len(unknown) != 0:
+        raise ValueError(f"Unknown columns {sorted(unknown)}. Available are: {list(candle_fields)}.")
+    return pa.schema([(name, candle_fields[name]) for name in columns])
+
+
+async def resolve_symbols(kind: str, symbols: List[str]) -> dict:
+    get_profile = pg_db.get_crypto if kind == "crypto" else pg_db.get_company
+    symbols_by_id = {}
+    for symbol in symbols:
+        profile = await get_profile(symbol)
+        if profile is None:
+            raise ValueError(f"Symbol `{symbol}` not found.")
+        symbols_by_id[profile["id"]] = symbol
+    return symbols_by_id
+
+
+async def candle_batches(
+    kind: str, symbols_by_id: dict, resolution: str, schema: pa.Schema,
+    startdate: datetime.datetime = None, enddate: datetime.datetime = None, batch_size: int = 65536
+):
+    names = ["c_id" if name == "symbol" else name for name in schema.names]
+
+    def to_batch(rows):
+        arrays = []
+        for name, field in zip(names, schema):
+            values = [row[name] for row in rows]
+            if name == "c_id":
+                values = [symbols_by_id[value] for value in values]
+            arrays.append(pa.array(values, type=field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    rows = []
+    table = candle_tables[kind]
+    async for row in pg_db.iterate_candles(table, list(symbols_by_id), resolution, names, startdate, enddate):
+        rows.append(row)
+        if len(rows) == batch_size:
+            yield to_batch(rows)
+            rows = []
+    if len(rows) != 0:
+        yield to_batch(rows)
+
+
+async def export_candles(batches, schema: pa.Schema, fmt: str):
+    sink = ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    async for batch in batches:
+        writer.write_batch(batch)
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+
+async def main(args):
+    await pg_db.connect()
+    try:
+        schema = candle_schema(args.columns.split(",") if args.columns else None)
+        symbols_by_id = await resolve_symbols(args.kind, args.symbols.split(","))
+        batches = candle_batches(args.kind, symbols_by_id, args.resolution, schema, args.startdate, args.enddate)
+        output = open(args.output, "wb") if args.output != "-" else sys.stdout.buffer
+        try:
+            async for data in export_candles(batches, schema, args.format):
+                output.write(data)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+    finally:
+        await pg_db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export candles as Arrow IPC stream or Parquet.")
+    parser.add_argument("--kind", choices=list(candle_tables), default="stock")
+    parser.add_argument("--symbols", required=True, help="Comma separated symbols.")
+    parser.add_argument("--resolution", required=True)
+    parser.add_argument("--startdate", type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument("--enddate", type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument("--columns", default=None, help=f"Comma separated subset of {list(candle_fields)}.")
+    parser.add_argument("--format", choices=list(media_types), default="arrow")
+    parser.add_argument("--output", default="-", help="Output file, `-` for stdout.")
+    asyncio.run(main(parser.parse_args()))
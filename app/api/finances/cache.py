@@ -0,0 +1,60 @@
+import time
+import hashlib
+from typing import Optional, Tuple
+from collections import OrderedDict
+from .throttler import get_redis
+
+
+class ResponseCache():
+    # Two tiers: a byte-bounded in-process LRU in front of a Redis cache shared by all processes.
+    # Entries stay servable for `stale` seconds after they stop being fresh, so callers can revalidate them
+    # in the background.
+    def __init__(self, prefix: str, max_bytes: int = 32 * 1024 * 1024):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def _redis_key(self, key: str) -> str:
+        return f"{self.prefix}:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    def _store(self, key: str, fresh_until: float, stale_until: float, text: str):
+        self._drop(key)
+        if len(text) > self.max_bytes:
+            return
+        self._entries[key] = (fresh_until, stale_until, text)
+        self.size += len(text)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[2])
+
+    async def get(self, key: str) -> Tuple[Optional[str], bool]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > now:
+            self._entries.move_to_end(key)
+            return entry[2], entry[0] > now
+        self._drop(key)
+
+        value = await get_redis().get(self._redis_key(key))
+        if value is None:
+            return None, False
+        header, text = value.decode("utf-8").split("\n", 1)
+        fresh_until, stale_until = (float(v) for v in header.split(" "))
+        if stale_until <= now:
+            return None, False
+        self._store(key, fresh_until, stale_until, text)
+        return text, fresh_until > now
+
+    async def set(self, key: str, text: str, ttl: float, stale: float = None):
+        stale = ttl if stale is None else stale
+        fresh_until = time.time() + ttl
+        stale_until = fresh_until + stale
+        self._store(key, fresh_until, stale_until, text)
+        await get_redis().set(
+            self._redis_key(key), f"{fresh_until} {stale_until}\n{text}", px=int((ttl + stale) * 1000)
+        )
@@ -0,0 +1,71 @@
+import datetime
+from typing import Dict, List
+import numpy as np
+
+
+class CandleBatch():
+    # Candles kept as one NumPy array per column. Columns that are the same for every row (`c_id`, `resolution`)
+    # are stored once as constants and only broadcast when rows are materialized.
+    fields = ("date", "open", "high", "low", "close", "volume")
+
+    def __init__(self, columns: Dict[str, np.ndarray], constants: dict = None):
+        self.columns = columns
+        self.constants = dict(constants or {})
+
+    @classmethod
+    def empty(cls, **constants) -> "CandleBatch":
+        return cls({
+            "date": np.empty(0, dtype="datetime64[s]"),
+            "open": np.empty(0, dtype=np.float64),
+            "high": np.empty(0, dtype=np.float64),
+            "low": np.empty(0, dtype=np.float64),
+            "close": np.empty(0, dtype=np.float64),
+            "volume": np.empty(0, dtype=np.int64)
+        }, constants)
+
+    @classmethod
+    def from_finnhub(cls, data: dict, **constants) -> "CandleBatch":
+        return cls({
+            "date": np.asarray(data["t"], dtype=np.int64).astype("datetime64[s]"),
+            "open": np.asarray(data["o"], dtype=np.float64),
+            "high": np.asarray(data["h"], dtype=np.float64),
+            "low": np.asarray(data["l"], dtype=np.float64),
+            "close": np.asarray(data["c"], dtype=np.float64),
+            "volume": np.asarray(data["v"], dtype=np.float64).astype(np.int64)
+        }, constants)
+
+    def __len__(self) -> int:
+        return len(self.columns["date"])
+
+    def with_constants(self, **constants) -> "CandleBatch":
+        self.constants.update(constants)
+        return self
+
+    def min_date(self) -> datetime.datetime:
+        return self.columns["date"].min().astype("datetime64[us]").item()
+
+    def max_date(self) -> datetime.datetime:
+        return self.columns["date"].max().astype("datetime64[us]").item()
+
+    def day_offsets(self):
+        # Calendar day of every candle and its offset into that day in seconds, for the packed per-day layout.
+        days = self.columns["date"].astype("datetime64[D]")
+        seconds = (self.columns["date"] - days).astype(np.int64)
+        return days.tolist(), seconds.tolist()
+
+    def column(self, name: str) -> list:
+        if name in self.constants:
+            return [self.constants[name]] * len(self)
+        if name == "date":
+            return self.columns["date"].astype("datetime64[us]").tolist()
+        return self.columns[name].tolist()
+
+    def arrays(self, names: List[str]) -> List[list]:
+        return [self.column(name) for name in names]
+
+    def records(self, names: List[str]):
+        return zip(*self.arrays(names))
+
+    def to_dicts(self) -> List[dict]:
+        names = list(self.fields) + list(self.constants)
+        return [dict(zip(names, record)) for record in self.records(names)]
@@ -1,25 +1,49 @@
 import os
 import datetime
-from .throttler import Limit, FinnnhubThrottler
+import hashlib
+from .throttler import Limit, Bucket, FinnnhubThrottler, TransientRequestError
+from .cache import ResponseCache
+from .candles import CandleBatch
 
 
 class FinnHub(FinnnhubThrottler):
+    # Reference data that changes at most daily is served from the response cache.
+    cache_ttls = {
+        "/stock/profile": 24 * 60 * 60,
+        "/stock/symbol": 24 * 60 * 60,
+        "/search": 24 * 60 * 60,
+        "/crypto/exchange": 24 * 60 * 60,
+        "/crypto/symbol": 24 * 60 * 60
+    }
 
     def __init__(self):
         self.url = "https://finnhub.io/api/v1"
-        self.apikey = os.getenv("FH_APIKEY")
-        if self.apikey is None:
+        self.apikeys = [
+            key.strip() for key in (os.getenv("FH_APIKEYS") or os.getenv("FH_APIKEY", "")).split(",")
+            if len(key.strip()) != 0
+        ]
+        if len(self.apikeys) == 0:
             raise ValueError(
                 "API key for FinnHub was not found."
-                " Set it into `.env` file as `FH_APIKEY`."
+                " Set it into `.env` file as `FH_APIKEY` (or a comma separated list as `FH_APIKEYS`)."
             )
 
         self.resolutions = ["1", "5", "15", "30", "60", "D", "W", "M"]
         self.priorities = [1, 2, 2, 4, 6, 8, 8, 8]
 
-        super(FinnHub, self).__init__([
-            Limit(30, 1, 0.5, "fh:short"), Limit(150, 60, 5, "fh:long")
-        ])
+        super(FinnHub, self).__init__(
+            [self.__key_bucket(key) for key in self.apikeys],
+            lease_size=int(float(os.getenv("FH_LEASE_SIZE", "1"))),
+            lease_ttl=float(os.getenv("FH_LEASE_TTL", "0")),
+            reserved=float(os.getenv("FH_INTERACTIVE_RESERVE", "0.2")),
+            shared_flights=bool(int(float(os.getenv("FH_SHARED_FLIGHTS", "0")))),
+            cache=ResponseCache("fh:cache", max_bytes=int(float(os.getenv("FH_CACHE_MAX_BYTES", "33554432"))))
+        )
+
+    def __key_bucket(self, apikey: str) -> Bucket:
+        # Limits are named after a fingerprint so the keys do not leak through `/status`.
+        name = hashlib.sha1(apikey.encode("utf-8")).hexdigest()[:8]
+        return Bucket([Limit(30, 1, 0.5, f"fh:{name}:short"), Limit(150, 60, 5, f"fh:{name}:long")], apikey)
 
     def __transform_date(self, date):
         if isinstance(date, str):
@@ -34,31 +58,37 @@ class FinnHub(FinnnhubThrottler):
                 return None
         return None
 
+    def __candles(self, result: dict, resolution: str) -> CandleBatch:
+        # Only `no_data` (or an empty `ok`) means there is nothing to store. Any other status raises, so the task
+        # is retried instead of its window being recorded as fetched.
+        if result.get("s") == "ok" and result.get("t") is not None:
+            return CandleBatch.from_finnhub(result, resolution=resolution)
+        if result.get("s") in ("ok", "no_data"):
+            return CandleBatch.empty(resolution=resolution)
+        raise TransientRequestError(200, f"Unexpected candle status `{result.get('s')}`.")
+
     async def __get_financials(self, params):
         path = "/stock/financials"
         result = []
         for freq in ["annual", "quarterly"]:
             params["freq"] = freq
-            async with await self.make_request("GET", self.url + path, params=params) as response:
-                data = await response.json()
-                if data["financials"] is not None:
-                    for res in data["financials"]:
-                        res["date"] = self.__transform_date(res.get("period", ""))
-                        res["period"] = freq
-                        res["symbol"] = params["symbol"]
-                    result += data["financials"]
+            data = await self.request_json("GET", self.url + path, params=params)
+            if data["financials"] is not None:
+                for res in data["financials"]:
+                    res["date"] = self.__transform_date(res.get("period", ""))
+                    res["period"] = freq
+                    res["symbol"] = params["symbol"]
+                result += data["financials"]
         return result
 
     # Fundamentals
     async def get_profile(self, symbol: str) -> dict:
         path = "/stock/profile"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
 
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            data = await response.json()
+        data = await self.request_json("GET", self.url + path, params=params, ttl=self.cache_ttls[path])
 
         result = None
         if len(data) != 0:
@@ -102,12 +132,10 @@ class FinnHub(FinnnhubThrottler):
         params = {
             "symbol": symbol,
             "from": _from.date().isoformat(),
-            "to": _to.date().isoformat(),
-            "token": self.apikey
+            "to": _to.date().isoformat()
         }
 
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
 
         for res in result:
             res["_id"] = res.pop("id")
@@ -140,37 +168,32 @@ class FinnHub(FinnnhubThrottler):
         params = {
             "symbol": symbol,
             "from": _from.date().isoformat(),
-            "to": _to.date().isoformat(),
-            "token": self.apikey
+            "to": _to.date().isoformat()
         }
 
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            data = await response.json()
-            result = [cleanup_chunk(chunk) for chunk in data.get("majorDevelopment", [])]
+        data = await self.request_json("GET", self.url + path, params=params)
+        result = [cleanup_chunk(chunk) for chunk in data.get("majorDevelopment", [])]
 
         return result
 
     async def get_balance_sheets(self, symbol: str):
         params = {
             "symbol": symbol,
-            "statement": "bs",
-            "token": self.apikey
+            "statement": "bs"
         }
         return await self.__get_financials(params)
 
     async def get_income_statements(self, symbol: str):
         params = {
             "symbol": symbol,
-            "statement": "ic",
-            "token": self.apikey
+            "statement": "ic"
         }
         return await self.__get_financials(params)
 
     async def get_cash_flows(self, symbol: str):
         params = {
             "symbol": symbol,
-            "statement": "cf",
-            "token": self.apikey
+            "statement": "cf"
         }
         return await self.__get_financials(params)
 
@@ -179,34 +202,29 @@ class FinnHub(FinnnhubThrottler):
         params = {
             "symbol": symbol,
             "from": _from.date().isoformat(),
-            "to": _to.date().isoformat(),
-            "token": self.apikey
+            "to": _to.date().isoformat()
         }
         filings = []
         for form in ["10-K", "10-Q"]:
             params["form"] = form
-            async with await self.make_request("GET", self.url + path, params=params) as response:
-                data = await response.json()
-                filings += [{
-                    "date": self.__transform_date(chunk.get("acceptedDate")),
-                    "access_number": chunk["accessNumber"],
-                    "form": chunk["form"]
-                } for chunk in data]
+            data = await self.request_json("GET", self.url + path, params=params)
+            filings += [{
+                "date": self.__transform_date(chunk.get("acceptedDate")),
+                "access_number": chunk["accessNumber"],
+                "form": chunk["form"]
+            } for chunk in data]
         return filings
 
     async def get_sec_sentiments(self, filings: list) -> list:
         path = "/stock/filings-sentiment"
-        params = {
-            "token": self.apikey
-        }
+        params = {}
         result = []
         for i, filing in enumerate(filings):
             params["accessNumber"] = filing["access_number"]
             try:
-                async with await self.make_request("GET", self.url + path, params=params) as response:
-                    data = await response.json()
-                    sentiments = dict((k.replace("-", "_"), v) for k, v in data.get("sentiment", {}).items())
-                    result.append({**filings, **sentiments})
+                data = await self.request_json("GET", self.url + path, params=params)
+                sentiments = dict((k.replace("-", "_"), v) for k, v in data.get("sentiment", {}).items())
+                result.append({**filings, **sentiments})
             except Exception:
                 pass
 
@@ -215,26 +233,24 @@ class FinnHub(FinnnhubThrottler):
     async def get_similarity_index(self, symbol: str) -> list:
         path = "/stock/similarity-index"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
         result = []
         for freq in ["annual", "quarterly"]:
             params["freq"] = freq
-            async with await self.make_request("GET", self.url + path, params=params) as response:
-                data = await response.json()
-                data = data.get("similarity", [])
-                if data is not None:
-                    result += [{
-                        "date": self.__transform_date(chunk.get("acceptedDate", "")),
-                        "form": chunk["form"],
-                        "access_number": chunk["accessNumber"],
-                        "item1": chunk.get("item1", -1),
-                        "item2": chunk.get("item2", -1),
-                        "item1A": chunk.get("Item1A", -1),
-                        "item7": chunk.get("item7", -1),
-                        "item7A": chunk.get("Item7A", -1)
-                    } for chunk in data]
+            data = await self.request_json("GET", self.url + path, params=params)
+            data = data.get("similarity", [])
+            if data is not None:
+                result += [{
+                    "date": self.__transform_date(chunk.get("acceptedDate", "")),
+                    "form": chunk["form"],
+                    "access_number": chunk["accessNumber"],
+                    "item1": chunk.get("item1", -1),
+                    "item2": chunk.get("item2", -1),
+                    "item1A": chunk.get("Item1A", -1),
+                    "item7": chunk.get("item7", -1),
+                    "item7A": chunk.get("Item7A", -1)
+                } for chunk in data]
         return result
 
     async def get_dividends(self, symbol: str, _from: datetime.datetime, _to: datetime.datetime) -> list:
@@ -242,43 +258,37 @@ class FinnHub(FinnnhubThrottler):
         params = {
             "symbol": symbol,
             "from": _from.date().isoformat(),
-            "to": _to.date().isoformat(),
-            "token": self.apikey
+            "to": _to.date().isoformat()
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            data = await response.json()
-            result = [{
-                "date": self.__transform_date(chunk.get("date", "")),
-                "pay_date": self.__transform_date(chunk.get("payDate", "")),
-                "record_date": self.__transform_date(chunk.get("recordDate", "")),
-                "declaration_date": self.__transform_date(chunk.get("declarationDate", "")),
-                "currency": chunk["currency"],
-                "amount": chunk["amount"],
-                "adj_amount": chunk["adjustedAmount"]
-            } for chunk in data]
+        data = await self.request_json("GET", self.url + path, params=params)
+        result = [{
+            "date": self.__transform_date(chunk.get("date", "")),
+            "pay_date": self.__transform_date(chunk.get("payDate", "")),
+            "record_date": self.__transform_date(chunk.get("recordDate", "")),
+            "declaration_date": self.__transform_date(chunk.get("declarationDate", "")),
+            "currency": chunk["currency"],
+            "amount": chunk["amount"],
+            "adj_amount": chunk["adjustedAmount"]
+        } for chunk in data]
         return result
 
     async def get_available_stocks(self, exchange: str = "US", currency: str = "USD"):
         path = "/stock/symbol"
         params = {
             "exchange": exchange,
-            "currency": currency,
-            "token": self.apikey
+            "currency": currency
         }
 
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params, ttl=self.cache_ttls[path])
         return result
 
     async def stocks_symbol_lookup(self, query: str):
         path = "/search"
         params = {
-            "q": query,
-            "token": self.apikey
+            "q": query
         }
 
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params, ttl=self.cache_ttls[path])
         return result["result"]
 
     # Stocks
@@ -289,38 +299,17 @@ class FinnHub(FinnnhubThrottler):
             "resolution": resolution,
             "from": int(_from.timestamp()),
             "to": int(_to.timestamp()),
-            "format": "json",
-            "token": self.apikey
+            "format": "json"
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            try:
-                result = await response.json()
-            except Exception:
-                result = {"s": "error"}
-        if result["s"] == "ok" and result["t"] is not None:
-            result = [
-                {
-                    "date": self.__transform_date(result["t"][i]),
-                    "open": result["o"][i],
-                    "high": result["h"][i],
-                    "low": result["l"][i],
-                    "close": result["c"][i],
-                    "volume": result["v"][i],
-                    "resolution": resolution
-                }
-                for i in range(len(result["t"]))
-            ]
-            return result
-        return []
+        result = await self.request_json("GET", self.url + path, params=params)
+        return self.__candles(result, resolution)
 
     async def get_stock_candle_latest(self, symbol: str):
         path = "/quote"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
         return {
             "open": result["o"],
             "close": result["c"],
@@ -335,11 +324,9 @@ class FinnHub(FinnnhubThrottler):
             "date": date.date().isoformat(),
             "limit": limit,
             "skip": skip,
-            "format": "csv",
-            "token": self.apikey
+            "format": "csv"
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
 
         data = [{
             "price": result["p"][i],
@@ -355,11 +342,9 @@ class FinnHub(FinnnhubThrottler):
     async def get_latest_bid_ask(self, symbol: str):
         path = "/stock/bidask"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
         return {
             "date": self.__transform_date(result["t"]),
             "ask": result["a"],
@@ -375,11 +360,9 @@ class FinnHub(FinnnhubThrottler):
             "date": date.date().isoformat(),
             "limit": limit,
             "skip": skip,
-            "format": "csv",
-            "token": self.apikey
+            "format": "csv"
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
 
         data = [{
             "ask": result["a"][i],
@@ -399,11 +382,9 @@ class FinnHub(FinnnhubThrottler):
         params = {
             "symbol": symbol,
             "from": _from.date().isoformat(),
-            "to": _to.date().isoformat(),
-            "token": self.apikey
+            "to": _to.date().isoformat()
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
         for res in result:
             res["date"] = self.__transform_date(res.get("date", ""))
             res["fromFactor"] = float(res["fromFactor"])
@@ -415,11 +396,9 @@ class FinnHub(FinnnhubThrottler):
     async def get_trends(self, symbol: str):
         path = "/stock/recommendation"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
         for res in result:
             res["date"] = self.__transform_date(res.pop("period", ""))
             del res["symbol"]
@@ -428,11 +407,9 @@ class FinnHub(FinnnhubThrottler):
     async def get_target_price(self, symbol: str):
         path = "/stock/price-target"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
         result["date"] = self.__transform_date(result.pop("lastUpdated", ""))
         del result["symbol"]
         return result
@@ -440,11 +417,9 @@ class FinnHub(FinnnhubThrottler):
     async def get_eps_surprises(self, symbol: str):
         path = "/stock/earnings"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
         for res in result:
             res["date"] = self.__transform_date(res.pop("period", ""))
             del res["symbol"]
@@ -453,14 +428,12 @@ class FinnHub(FinnnhubThrottler):
     async def get_eps_estimates(self, symbol: str):
         path = "/stock/eps-estimate"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
         data = []
         for freq in ["annual", "quarterly"]:
             params["freq"] = freq
-            async with await self.make_request("GET", self.url + path, params=params) as response:
-                result = await response.json()
+            result = await self.request_json("GET", self.url + path, params=params)
             for res in result["data"]:
                 res["date"] = self.__transform_date(res.pop("period", ""))
             data += [{**d, "freq": freq} for d in result["data"]]
@@ -470,14 +443,12 @@ class FinnHub(FinnnhubThrottler):
     async def get_revenue_estimates(self, symbol: str):
         path = "/stock/revenue-estimate"
         params = {
-            "symbol": symbol,
-            "token": self.apikey
+            "symbol": symbol
         }
         data = []
         for freq in ["annual", "quarterly"]:
             params["freq"] = freq
-            async with await self.make_request("GET", self.url + path, params=params) as response:
-                result = await response.json()
+            result = await self.request_json("GET", self.url + path, params=params)
             for res in result["data"]:
                 res["date"] = self.__transform_date(res.pop("period", ""))
             data += [{**d, "freq": freq} for d in result["data"]]
@@ -489,17 +460,14 @@ class FinnHub(FinnnhubThrottler):
         _from: datetime.datetime = None, _to: datetime.datetime = None
     ):
         path = "/stock/upgrade-downgrade"
-        params = {
-            "token": self.apikey
-        }
+        params = {}
         if symbol is not None:
             params["symbol"] = symbol
         if _from is not None:
             params["from"] = _from.date().isoformat()
         if _to is not None:
             params["to"] = _to.date().isoformat()
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params)
         for res in result:
             res["date"] = self.__transform_date(res.pop("gradeTime"))
             del res["symbol"]
@@ -510,11 +478,9 @@ class FinnHub(FinnnhubThrottler):
         params = {
             "symbol": symbol,
             "from": _from.date().isoformat(),
-            "to": _to.date().isoformat(),
-            "token": self.apikey
+            "to": _to.date().isoformat()
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = (await response.json())["earningsCalendar"]
+        result = (await self.request_json("GET", self.url + path, params=params))["earningsCalendar"]
         for res in result:
             res["date"] = self.__transform_date(res.get("date", ""))
             del res["symbol"]
@@ -524,21 +490,16 @@ class FinnHub(FinnnhubThrottler):
     # Crypto
     async def get_crypto_exchanges(self):
         path = "/crypto/exchange"
-        params = {
-            "token": self.apikey
-        }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        params = {}
+        result = await self.request_json("GET", self.url + path, params=params, ttl=self.cache_ttls[path])
         return result
 
     async def get_crypto_symbols(self, exchange: str):
         path = "/crypto/symbol"
         params = {
-            "exchange": exchange,
-            "token": self.apikey
+            "exchange": exchange
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
+        result = await self.request_json("GET", self.url + path, params=params, ttl=self.cache_ttls[path])
         return result
 
     async def get_crypto_candles(self, symbol: str, resolution: str, _from: datetime.datetime, _to: datetime.datetime):
@@ -548,23 +509,7 @@ class FinnHub(FinnnhubThrottler):
             "resolution": resolution,
             "from": int(_from.timestamp()),
             "to": int(_to.timestamp()),
-            "format": "json",
-            "token": self.apikey
+            "format": "json"
         }
-        async with await self.make_request("GET", self.url + path, params=params) as response:
-            result = await response.json()
-        if result["s"] == "ok" and result["t"] is not None:
-            result = [
-                {
-                    "date": self.__transform_date(result["t"][i]),
-                    "open": result["o"][i],
-                    "close": result["c"][i],
-                    "high": result["h"][i],
-                    "low": result["l"][i],
-                    "volume": result["v"][i],
-                    "resolution": resolution
-                }
-                for i in range(len(result["t"]))
-            ]
-            return result
-        return []
+        result = await self.request_json("GET", self.url + path, params=params)
+        return self.__candles(result, resolution)
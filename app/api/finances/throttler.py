@@ -1,75 +1,353 @@
+import json
 import logging
+import hashlib
 from os import getenv
 import time
+import uuid
 from typing import List
+import math
+import random
+import heapq
+import itertools
 import asyncio
+from contextvars import ContextVar
 import aiohttp
-from redis import Redis
+from redis.asyncio import Redis, BlockingConnectionPool
 from gql import Client
 from gql.transport.aiohttp import AIOHTTPTransport, log
+from gql.transport.exceptions import TransportClosed
 
 log.setLevel(logging.ERROR)
 
 
+# KEYS: the limit keys of every candidate bucket, then the keys of the bucket to settle.
+# ARGV: tokens to lease, lease ttl, lease id, limits per bucket, number of candidate buckets,
+# (capacity, period) for every candidate key, then (member, used at) pairs of the previous lease to settle.
+ACQUIRE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local count = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+local size = tonumber(ARGV[4])
+local buckets = tonumber(ARGV[5])
+local settle = 6 + 2 * buckets * size
+
+for i, key in ipairs(KEYS) do
+    if redis.call("TYPE", key).ok ~= "zset" then
+        redis.call("DEL", key)
+    end
+end
+for i = buckets * size + 1, #KEYS do
+    for j = settle, #ARGV, 2 do
+        if ARGV[j + 1] == "" then
+            redis.call("ZREM", KEYS[i], ARGV[j])
+        else
+            redis.call("ZADD", KEYS[i], "XX", ARGV[j + 1], ARGV[j])
+        end
+    end
+end
+
+local best = 0
+local best_free = 0
+local wait = -1
+for b = 0, buckets - 1 do
+    local free = math.huge
+    local bucket_wait = 0
+    for l = 1, size do
+        local i = b * size + l
+        local rate = tonumber(ARGV[4 + 2 * i])
+        local period = tonumber(ARGV[5 + 2 * i])
+        redis.call("ZREMRANGEBYSCORE", KEYS[i], "-inf", now - period)
+        local left = rate - redis.call("ZCARD", KEYS[i])
+        if left <= 0 then
+            local earliest = redis.call("ZRANGE", KEYS[i], 0, 0, "WITHSCORES")
+            if earliest[2] then
+                bucket_wait = math.max(bucket_wait, tonumber(earliest[2]) + period - now)
+            else
+                bucket_wait = math.max(bucket_wait, period)
+            end
+        end
+        free = math.min(free, left)
+    end
+    if free > best_free then
+        best = b + 1
+        best_free = free
+    elseif free <= 0 and (wait < 0 or bucket_wait < wait) then
+        wait = bucket_wait
+    end
+end
+if best == 0 then
+    return {0, 0, tostring(wait)}
+end
+
+count = math.min(count, best_free)
+for l = 1, size do
+    local i = (best - 1) * size + l
+    for j = 1, count do
+        redis.call("ZADD", KEYS[i], now + ttl, ARGV[3] .. ":" .. j)
+    end
+    redis.call("PEXPIRE", KEYS[i], math.ceil((tonumber(ARGV[5 + 2 * i]) + ttl) * 1000))
+end
+return {best, count, tostring(now)}
+"""
+
+# Flight locks are only extended or released by the owner whose id they still hold.
+EXTEND_FLIGHT_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_FLIGHT_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+request_priority = ContextVar("request_priority", default=BACKGROUND)
+
+_redis = None
+
+
+def get_redis() -> Redis:
+    # Created lazily so the pool is bound to the running event loop. Callers queue for a free connection
+    # instead of failing when all of them are in use.
+    global _redis
+    if _redis is None:
+        _redis = Redis(connection_pool=BlockingConnectionPool(
+            host=getenv("REDIS_HOST"), port=int(getenv("REDIS_PORT")),
+            db=int(float(getenv("REDIS_THROTTLER_DB"))),
+            max_connections=int(float(getenv("REDIS_THROTTLER_MAX_CONN", "32"))),
+            timeout=float(getenv("REDIS_THROTTLER_POOL_TIMEOUT", "20"))
+        ))
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.connection_pool.disconnect()
+        _redis = None
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super(RequestError, self).__init__(f"Request failed with status {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class PermanentRequestError(RequestError):
+    pass
+
+
+class TransientRequestError(RequestError):
+    pass
+
+
 class Limit():
     def __init__(self, rate: int, period: float, retry: float, key: str):
         self.rate = rate
         self.period = period
         self.retry = retry
-        self.redis = Redis(
-            host=getenv("REDIS_HOST"), port=getenv("REDIS_PORT"),
-            db=int(float(getenv("REDIS_THROTTLER_DB")))
-        )
         self.key = key
+        self.scale = 1.0
 
-    def flush(self):
-        while self.redis.llen(self.key):
-            earliest = self.redis.lindex(self.key, 0)
-            if earliest is not None:
-                now = time.time()
-                earliest = float(earliest.decode("utf-8"))
-                if now - earliest > self.period:
-                    self.redis.lpop(self.key)
-                else:
-                    break
-            else:
-                break
+    @property
+    def effective_rate(self) -> int:
+        return max(1, int(self.rate * self.scale))
 
-    async def acquire(self):
-        while True:
-            self.flush()
-            if self.redis.llen(self.key) < self.rate:
-                break
-            await asyncio.sleep(self.retry)
+    def decrease(self):
+        self.scale = max(0.1, self.scale / 2)
+
+    def increase(self):
+        self.scale = min(1.0, self.scale + 0.5 / self.rate)
 
-    def get_status(self):
-        self.flush()
+    async def get_status(self):
+        async with get_redis().pipeline() as pipe:
+            pipe.zremrangebyscore(self.key, "-inf", time.time() - self.period)
+            pipe.zcard(self.key)
+            _, used = await pipe.execute()
         return {
             "name": self.key,
-            "opened": self.redis.llen(self.key) < self.rate,
-            "used": self.redis.llen(self.key),
+            "opened": used < self.effective_rate,
+            "used": used,
             "rate": self.rate,
+            "effective_rate": self.effective_rate,
             "period": self.period,
             "retry": self.retry
         }
 
-    def push(self):
-        self.redis.rpush(self.key, time.time())
 
+class Bucket():
+    # A set of limits that are consumed together, e.g. the windows of one API key.
+    # A key answered with 401 is taken out of rotation for `revoke_cooldown` seconds, then probed again.
+    revoke_cooldown = float(getenv("THROTTLER_REVOKE_COOLDOWN", "900"))
 
-class BasicThrottler():
-    def __init__(self, limits: List[Limit]):
+    def __init__(self, limits: List[Limit], token: str = None):
         self.limits = sorted(limits, key=lambda x: x.period)
+        self.token = token
+        self.paused_until = 0.0
+        self.revoked_until = 0.0
+
+    @property
+    def revoked(self) -> bool:
+        return self.revoked_until > time.time()
+
+    def revoke(self):
+        self.revoked_until = time.time() + self.revoke_cooldown
+
+    @property
+    def available(self) -> bool:
+        return not self.revoked and self.paused_until <= time.time()
+
+
+class Lease():
+    # Tokens are reserved in Redis until the lease expires and re-stamped with the time they were really used
+    # (or given back) when the lease is settled, so the shared windows stay exact.
+    def __init__(self, _id: str, bucket: Bucket, size: int, start: float, ttl: float):
+        self.id = _id
+        self.bucket = bucket
+        self.size = size
+        self.start = start
+        self.started = time.monotonic()
+        self.ttl = ttl
+        self.used = [start]
+
+    def take(self) -> bool:
+        elapsed = time.monotonic() - self.started
+        if elapsed >= self.ttl or len(self.used) >= self.size or not self.bucket.available:
+            return False
+        self.used.append(self.start + elapsed)
+        return True
+
+    def settlement(self) -> list:
+        args = []
+        for i in range(self.size):
+            args += [f"{self.id}:{i + 1}", repr(self.used[i]) if i < len(self.used) else ""]
+        return args
+
+
+class BasicThrottler():
+    def __init__(self, buckets: List[Bucket], lease_size: int = 1, lease_ttl: float = 0, reserved: float = 0):
+        self.buckets = buckets
+        self.lease_size = lease_size if lease_ttl > 0 else 1
+        self.lease_ttl = lease_ttl
+        self.reserved = reserved
+        self._lease = None
+        self._lease_lock = None
+        self._acquire_script = None
+        self._waiters = []
+        self._counter = itertools.count()
+
+    @property
+    def limits(self) -> List[Limit]:
+        return [limit for bucket in self.buckets for limit in bucket.limits]
+
+    @property
+    def acquire_script(self):
+        if self._acquire_script is None:
+            self._acquire_script = get_redis().register_script(ACQUIRE_SCRIPT)
+        return self._acquire_script
 
-    def get_status(self):
-        return [limit.get_status() for limit in self.limits]
+    async def get_status(self):
+        return [await limit.get_status() for limit in self.limits]
 
-    async def acquire(self):
-        for limit in self.limits:
-            await limit.acquire()
+    def capacity(self, limit: Limit, priority: int) -> int:
+        # Background callers may only fill the part of each window that is not reserved for interactive ones.
+        rate = limit.effective_rate
+        if priority == INTERACTIVE:
+            return rate
+        return max(1, rate - math.ceil(rate * self.reserved))
 
-        for limit in self.limits:
-            limit.push()
+    def _take(self) -> Bucket:
+        if self._lease is not None and self._lease.take():
+            return self._lease.bucket
+        return None
+
+    async def acquire(self) -> Bucket:
+        if len(self._waiters) == 0:
+            bucket = self._take()
+            if bucket is not None:
+                return bucket
+
+        # Only the first waiter of this process (by priority, then arrival) talks to Redis,
+        # the rest sleep until they get to the head of the queue.
+        priority = request_priority.get()
+        waiter = [priority, next(self._counter), None]
+        heapq.heappush(self._waiters, waiter)
+        try:
+            while True:
+                wait = None
+                if self._waiters[0] is waiter:
+                    bucket = self._take()
+                    if bucket is None:
+                        bucket, wait = await self._reserve(priority)
+                    if bucket is not None:
+                        return bucket
+                waiter[2] = asyncio.get_event_loop().create_future()
+                try:
+                    await asyncio.wait_for(waiter[2], wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+            self._wake()
+
+    def _wake(self):
+        if len(self._waiters) != 0 and self._waiters[0][2] is not None and not self._waiters[0][2].done():
+            self._waiters[0][2].set_result(None)
+
+    async def _reserve(self, priority: int, count: int = None):
+        if count is None:
+            count = self.lease_size if priority == BACKGROUND else 1
+
+        candidates = [bucket for bucket in self.buckets if bucket.available] if count > 0 else []
+        if count > 0 and len(candidates) == 0:
+            if all(bucket.revoked for bucket in self.buckets):
+                raise PermanentRequestError(401, "All API keys are revoked.")
+            return None, min(bucket.paused_until for bucket in self.buckets if not bucket.revoked) - time.time()
+
+        keys = [limit.key for bucket in candidates for limit in bucket.limits]
+        args = [
+            value
+            for bucket in candidates for limit in bucket.limits
+            for value in (self.capacity(limit, priority), limit.period)
+        ]
+        # Background callers are the only ones that take leases, interactive tokens are stamped as used right away.
+        ttl = self.lease_ttl if priority == BACKGROUND else 0
+
+        # Settling the current lease and storing the next one is serialized, so a concurrent reservation
+        # cannot replace a lease that was never settled.
+        if self._lease_lock is None:
+            self._lease_lock = asyncio.Lock()
+        async with self._lease_lock:
+            if self._lease is not None:
+                keys += [limit.key for limit in self._lease.bucket.limits]
+                args += self._lease.settlement()
+            self._lease = None
+
+            lease_id = uuid.uuid4().hex
+            chosen, granted, value = await self.acquire_script(
+                keys=keys,
+                args=[count, ttl, lease_id, len(self.buckets[0].limits), len(candidates)] + args
+            )
+            if chosen == 0:
+                return None, float(value)
+            bucket = candidates[chosen - 1]
+            if ttl > 0:
+                self._lease = Lease(lease_id, bucket, granted, float(value), ttl)
+        return bucket, None
+
+    async def release(self):
+        if self._lease is not None:
+            await self._reserve(BACKGROUND, 0)
 
     async def make_request(self, *args, **kwargs):
         raise NotImplementedError()
@@ -79,39 +357,229 @@ class BasicThrottler():
 
 
 class FinnnhubThrottler(BasicThrottler):
-    def __init__(self, limits: List[Limit]):
+    # Finnhub reports its per-minute quota in the X-Ratelimit-* headers.
+    quota_period = 60
+    transient_statuses = (408, 425, 429)
+
+    def __init__(
+        self, buckets: List[Bucket], lease_size: int = 1, lease_ttl: float = 0, reserved: float = 0,
+        max_retries: int = 8, backoff: float = 0.5, max_backoff: float = 60,
+        shared_flights: bool = False, flight_timeout: float = 60, cache=None
+    ):
         self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10 * 60))
-        super(FinnnhubThrottler, self).__init__(limits)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.shared_flights = shared_flights
+        self.flight_timeout = flight_timeout
+        self.cache = cache
+        self._flights = {}
+        self._extend_flight_script = None
+        self._release_flight_script = None
+        super(FinnnhubThrottler, self).__init__(buckets, lease_size, lease_ttl, reserved)
 
-    async def make_request(self, *args, **kwargs):
+    @property
+    def extend_flight_script(self):
+        if self._extend_flight_script is None:
+            self._extend_flight_script = get_redis().register_script(EXTEND_FLIGHT_SCRIPT)
+        return self._extend_flight_script
+
+    @property
+    def release_flight_script(self):
+        if self._release_flight_script is None:
+            self._release_flight_script = get_redis().register_script(RELEASE_FLIGHT_SCRIPT)
+        return self._release_flight_script
+
+    def adapt(self, bucket: Bucket, resp: aiohttp.ClientResponse):
+        quota = resp.headers.get("X-Ratelimit-Limit")
+        remaining = resp.headers.get("X-Ratelimit-Remaining")
+        reset = resp.headers.get("X-Ratelimit-Reset")
+        retry_after = resp.headers.get("Retry-After")
+
+        try:
+            if quota is not None:
+                for limit in bucket.limits:
+                    if limit.period == self.quota_period:
+                        limit.rate = int(quota)
+            if remaining is not None and reset is not None and int(remaining) <= 0:
+                bucket.paused_until = max(bucket.paused_until, float(reset))
+            if retry_after is not None:
+                bucket.paused_until = max(bucket.paused_until, time.time() + float(retry_after))
+        except ValueError:
+            pass
+
+        if resp.status == 401:
+            bucket.revoke()
+        for limit in bucket.limits:
+            if resp.status == 429:
+                limit.decrease()
+            elif resp.ok:
+                limit.increase()
+
+    def get_backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def make_request(self, method: str, url: str, params: dict = None, **kwargs):
+        attempt = 0
         while True:
-            await self.acquire()
+            bucket = await self.acquire()
 
             try:
-                resp = await self.session.request(*args, **kwargs)
-            except (aiohttp.ClientOSError, asyncio.TimeoutError):
-                resp = None
+                resp = await self.session.request(
+                    method, url, params={**(params or {}), "token": bucket.token}, **kwargs
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                resp, status, message = None, 0, repr(e)
+
+            if resp is not None:
+                self.adapt(bucket, resp)
+                if resp.ok:
+                    return resp
+                status, message = resp.status, (await resp.text())[:256]
+                resp.release()
+                # A revoked key is drained and the request goes to another one.
+                if status < 500 and status not in self.transient_statuses and status != 401:
+                    raise PermanentRequestError(status, message)
 
-            if resp is not None and resp.ok:
-                break
-        return resp
+            attempt += 1
+            if attempt > self.max_retries:
+                raise TransientRequestError(status, message)
+            await asyncio.sleep(self.get_backoff(attempt))
+
+    async def request_json(self, method: str, url: str, params: dict = None, ttl: float = None):
+        # Identical concurrent GETs share one upstream call. Every caller decodes its own copy of the body
+        # because the callers modify the decoded result in place.
+        if method != "GET":
+            return json.loads(await self._fetch_text(method, url, params))
+
+        key = json.dumps([url, params or {}], sort_keys=True, default=str)
+        if ttl is not None and self.cache is not None:
+            text, fresh = await self.cache.get(key)
+            if text is not None:
+                if not fresh:
+                    self._start_flight(key, method, url, params, ttl)
+                return json.loads(text)
+        return json.loads(await asyncio.shield(self._start_flight(key, method, url, params, ttl)))
+
+    def _start_flight(self, key: str, method: str, url: str, params: dict = None, ttl: float = None):
+        def done(flight):
+            self._flights.pop(key, None)
+            if not flight.cancelled():
+                flight.exception()
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self._fetch_flight(key, method, url, params, ttl))
+            self._flights[key] = flight
+            flight.add_done_callback(done)
+        return flight
+
+    async def _fetch_text(self, method: str, url: str, params: dict = None) -> str:
+        async with await self.make_request(method, url, params=params) as resp:
+            if "json" not in resp.content_type:
+                raise aiohttp.ContentTypeError(
+                    resp.request_info, resp.history, status=resp.status, headers=resp.headers,
+                    message=f"Attempt to decode JSON with unexpected mimetype: {resp.content_type}"
+                )
+            return await resp.text()
+
+    async def _fetch_flight(self, key: str, method: str, url: str, params: dict = None, ttl: float = None) -> str:
+        text = await self._fetch_shared(key, method, url, params)
+        if ttl is not None and self.cache is not None:
+            await self.cache.set(key, text, ttl)
+        return text
+
+    async def _fetch_shared(self, key: str, method: str, url: str, params: dict = None) -> str:
+        if not self.shared_flights:
+            return await self._fetch_text(method, url, params)
+
+        # Across processes the first caller takes a lock and publishes the body under its flight id,
+        # the others poll for it and take over if the lock disappears without a result.
+        redis = get_redis()
+        name = "fh:flight:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+        while True:
+            flight_id = uuid.uuid4().hex
+            if await redis.set(name, flight_id, nx=True, px=int(self.flight_timeout * 1000)):
+                keeper = asyncio.ensure_future(self._keep_flight(name, flight_id))
+                try:
+                    text = await self._fetch_text(method, url, params)
+                    await redis.set(f"{name}:{flight_id}", text, px=int(self.flight_timeout * 1000))
+                    return text
+                finally:
+                    keeper.cancel()
+                    await self.release_flight_script(keys=[name], args=[flight_id])
+
+            owner = await redis.get(name)
+            while owner is not None:
+                await asyncio.sleep(0.05)
+                async with redis.pipeline(transaction=False) as pipe:
+                    pipe.get(f"{name}:{owner.decode('utf-8')}")
+                    pipe.get(name)
+                    text, current = await pipe.execute()
+                if text is not None:
+                    return text.decode("utf-8")
+                if current != owner:
+                    break
+
+    async def _keep_flight(self, name: str, flight_id: str):
+        # The lock outlives throttler waits and retries for as long as its owner is still working on the request.
+        while True:
+            await asyncio.sleep(self.flight_timeout / 3)
+            if not await self.extend_flight_script(keys=[name], args=[flight_id, int(self.flight_timeout * 1000)]):
+                return
 
     async def close(self):
         await self.session.close()
+        await self.release()
+        await close_redis()
 
 
 class FinimizeThrottler(BasicThrottler):
-    def __init__(self, limits: List[Limit], url: str, headers: dict):
+    # One long-lived GraphQL session per process; it is rebuilt when the connection breaks.
+    def __init__(self, limits: List[Limit], url: str, headers: dict, keepalive_timeout: float = 60):
         self.url = url
         self.headers = headers
+        self.keepalive_timeout = keepalive_timeout
+        self.client = None
+        self.session = None
+        self._connect_lock = None
 
-        super(FinimizeThrottler, self).__init__(limits)
+        super(FinimizeThrottler, self).__init__([Bucket(limits)])
+
+    async def connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.session is None:
+                transport = AIOHTTPTransport(
+                    url=self.url, headers=self.headers,
+                    client_session_args={"connector": aiohttp.TCPConnector(keepalive_timeout=self.keepalive_timeout)}
+                )
+                self.client = Client(transport=transport)
+                self.session = await self.client.connect_async()
+        return self.session
+
+    async def disconnect(self, session=None):
+        # Only the session that failed is dropped, a concurrent caller may have reconnected already.
+        if session is not None and session is not self.session:
+            return
+        client, self.client, self.session = self.client, None, None
+        if client is not None:
+            await client.close_async()
 
     async def make_request(self, *args, **kwargs):
         await self.acquire()
-        async with Client(transport=AIOHTTPTransport(url=self.url, headers=self.headers)) as session:
-            result = await session.execute(*args, **kwargs)
-        return result
+        session = await self.connect()
+        try:
+            return await session.execute(*args, **kwargs)
+        except (TransportClosed, aiohttp.ClientError):
+            await self.disconnect(session)
+
+        await self.acquire()
+        session = await self.connect()
+        return await session.execute(*args, **kwargs)
 
     async def close(self):
-        await self.transport.close()
+        await self.disconnect()
+        await self.release()
+        await close_redis()
@@ -1,10 +1,12 @@
 import os
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.logger import logger as api_logger
 from databases.core import logger as db_logger
 from db import pg_db, mongo_db
 from finances import fh, fm
+from finances.throttler import request_priority, INTERACTIVE, RequestError
 from routes import router
 
 gunicorn_logger = logging.getLogger("gunicorn.error")
@@ -17,9 +19,24 @@ app = FastAPI(redoc_url=None)
 app.include_router(router)
 
 
+@app.middleware("http")
+async def interactive_priority(request: Request, call_next):
+    request_priority.set(INTERACTIVE)
+    return await call_next(request)
+
+
+@app.exception_handler(RequestError)
+async def request_error_handler(request: Request, exc: RequestError):
+    return JSONResponse(
+        status_code=status.HTTP_502_BAD_GATEWAY,
+        content={"error": f"Upstream request failed with status {exc.status}."}
+    )
+
+
 @app.on_event("startup")
 async def startup():
     await pg_db.connect()
+    await mongo_db.ensure_indexes()
 
 
 @app.on_event("shutdown")
@@ -16,6 +16,7 @@ class RateLimitsModel(BaseModel):
     opened: bool
     used: int
     rate: int
+    effective_rate: int
     period: float
     retry: float
 
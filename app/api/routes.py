@@ -1,5 +1,9 @@
+import json
+import datetime
 from typing import Optional
 from fastapi import APIRouter, Query, Path, BackgroundTasks, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 
 from models import StatusModel
 from db import pg_db, mongo_db, data_functions, data_parameters
@@ -7,10 +11,16 @@ from finances import fh, fm
 from celery_worker.worker import celery_app
 
 from background_tasks import add_crypto_tasks
+from export import candle_tables, media_types, candle_schema, resolve_symbols, candle_batches, export_candles
 
 router = APIRouter()
 
 
+async def ndjson(rows):
+    async for row in rows:
+        yield json.dumps(jsonable_encoder(row)) + "\n"
+
+
 @router.get(
     "/status", response_model=StatusModel,
     summary="Status of the API.",
@@ -21,8 +31,8 @@ async def get_status():
     return {
         "postgres": pg_db.get_status(),
         "mongo": mongo_db.get_status(),
-        "finnhub": fh.get_status(),
-        "finimize": fm.get_status()
+        "finnhub": await fh.get_status(),
+        "finimize": await fm.get_status()
     }
 
 
@@ -177,11 +187,17 @@ async def get_data(
     resolution: Optional[str] = Query(None, title="Resolution", description="Resolution for candles."),
     content_type: Optional[str] = Query(None, title="Resolution", description="Content type for Finimize News."),
     limit: int = Query(100, title="Limit", description="Limit for response."),
-    offset: int = Query(0, title="Offset", description="Offset for response.")
+    offset: int = Query(0, title="Offset", description="Offset for response."),
+    cursor: Optional[str] = Query(
+        None, title="Cursor", description="Cursor of the page, as returned in the `X-Next-Cursor` header."
+    ),
+    stream: bool = Query(False, title="Stream", description="Stream rows as NDJSON instead of a single JSON page.")
 ):
     parameters = {
         "limit": limit,
-        "offset": offset
+        "offset": offset,
+        "cursor": cursor,
+        "stream": stream
     }
 
     if symbol:
@@ -206,8 +222,8 @@ async def get_data(
         return {"error": f"More than need parameters are included. Excess are {list(excess_parameters)}"}
 
     if "symbol" in data_parameters[function]:
-        company = await pg_db.get_company(symbol)
-        if company is None:
+        get_profile = pg_db.get_crypto if function.startswith("crypto") else pg_db.get_company
+        if await get_profile(symbol) is None:
             response.status_code = status.HTTP_400_BAD_REQUEST
             return {"error": f"Company {symbol} not found."}
 
@@ -219,4 +235,89 @@ async def get_data(
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"error": f"Wrong `content_type` parameter. Available are: {fm.content_types}."}
 
-    return await data_functions[function](**parameters)
+    try:
+        result = await data_functions[function](**parameters)
+    except ValueError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": str(e)}
+
+    if stream:
+        return StreamingResponse(ndjson(result), media_type="application/x-ndjson")
+    if result.next_cursor is not None:
+        response.headers["X-Next-Cursor"] = result.next_cursor
+    return result
+
+
+@router.get(
+    "/export_candles",
+    summary="Export candles",
+    description="Stream candles of several symbols as Arrow IPC stream or Parquet",
+    tags=["data"]
+)
+async def get_export_candles(
+    response: Response,
+    symbols: str = Query(..., title="Symbols", description="Comma separated symbols to export."),
+    resolution: str = Query(..., title="Resolution", description="Resolution for candles."),
+    kind: str = Query("stock", title="Kind", description=f"Candles kind. Available are: {list(candle_tables)}."),
+    startdate: Optional[datetime.datetime] = Query(None, title="Start date", description="Oldest candle to export."),
+    enddate: Optional[datetime.datetime] = Query(None, title="End date", description="Newest candle to export."),
+    columns: Optional[str] = Query(None, title="Columns", description="Comma separated columns to export."),
+    format: str = Query("arrow", title="Format", description=f"Output format. Available are: {list(media_types)}.")
+):
+    if kind not in candle_tables:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": f"Wrong `kind` parameter. Available are: {list(candle_tables)}."}
+
+    if format not in media_types:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": f"Wrong `format` parameter. Available are: {list(media_types)}."}
+
+    if resolution not in fh.resolutions:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": f"Wrong `resolution` parameter. Available are: {fh.resolutions}."}
+
+    try:
+        schema = candle_schema(columns.split(",") if columns else None)
+        symbols_by_id = await resolve_symbols(kind, symbols.split(","))
+    except ValueError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": str(e)}
+
+    batches = candle_batches(kind, symbols_by_id, resolution, schema, startdate, enddate)
+    return StreamingResponse(export_candles(batches, schema, format), media_type=media_types[format])
+
+
+@router.get(
+    "/get_candle_panel",
+    summary="Get aligned candles",
+    description="Get candles of several symbols aligned on their common timestamps",
+    tags=["data"]
+)
+async def get_candle_panel(
+    response: Response,
+    symbols: str = Query(..., title="Symbols", description="Comma separated symbols."),
+    resolution: str = Query(..., title="Resolution", description="Resolution for candles."),
+    kind: str = Query("stock", title="Kind", description=f"Candles kind. Available are: {list(candle_tables)}."),
+    startdate: Optional[datetime.datetime] = Query(None, title="Start date", description="Oldest timestamp."),
+    enddate: Optional[datetime.datetime] = Query(None, title="End date", description="Newest timestamp."),
+    limit: int = Query(1000, title="Limit", description="Number of most recent timestamps."),
+    fill: bool = Query(True, title="Fill", description="Forward-fill missing bars with the last close.")
+):
+    if kind not in candle_tables:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": f"Wrong `kind` parameter. Available are: {list(candle_tables)}."}
+
+    if resolution not in fh.resolutions:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": f"Wrong `resolution` parameter. Available are: {fh.resolutions}."}
+
+    try:
+        symbols_by_id = await resolve_symbols(kind, symbols.split(","))
+    except ValueError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"error": str(e)}
+
+    panel = await pg_db.candle_panel(
+        candle_tables[kind], list(symbols_by_id), resolution, limit, fill, startdate, enddate
+    )
+    return {"symbols": list(symbols_by_id.values()), **panel}
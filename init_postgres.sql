@@ -66,16 +66,17 @@ CREATE TABLE "dividends" (
 );
 
 CREATE TABLE "stocks_candles" (
-  "id" SERIAL UNIQUE PRIMARY KEY,
+  "id" SERIAL,
   "c_id" integer NOT NULL,
-  "date" timestamp,
+  "date" timestamp NOT NULL,
   "open" float(8) NOT NULL,
   "high" float(8) NOT NULL,
   "low" float(8) NOT NULL,
   "close" float(8) NOT NULL,
   "volume" bigint NOT NULL,
-  "resolution" varchar(2) NOT NULL
-);
+  "resolution" varchar(2) NOT NULL,
+  PRIMARY KEY ("id", "date")
+) PARTITION BY RANGE ("date");
 
 CREATE TABLE "splits" (
   "id" SERIAL UNIQUE PRIMARY KEY,
@@ -156,15 +157,59 @@ CREATE TABLE "crypto" (
 );
 
 CREATE TABLE "crypto_candles" (
-  "id" SERIAL UNIQUE PRIMARY KEY,
+  "id" SERIAL,
   "c_id" integer NOT NULL,
-  "date" timestamp,
+  "date" timestamp NOT NULL,
   "open" float(8) NOT NULL,
   "high" float(8) NOT NULL,
   "low" float(8) NOT NULL,
   "close" float(8) NOT NULL,
   "volume" bigint NOT NULL,
-  "resolution" varchar(2) NOT NULL
+  "resolution" varchar(2) NOT NULL,
+  PRIMARY KEY ("id", "date")
+) PARTITION BY RANGE ("date");
+
+CREATE TABLE "stocks_candles_packed" (
+  "c_id" integer NOT NULL,
+  "resolution" varchar(2) NOT NULL,
+  "day" date NOT NULL,
+  "time" integer[] NOT NULL,
+  "open" double precision[] NOT NULL,
+  "high" double precision[] NOT NULL,
+  "low" double precision[] NOT NULL,
+  "close" double precision[] NOT NULL,
+  "volume" bigint[] NOT NULL,
+  PRIMARY KEY ("c_id", "resolution", "day")
+);
+
+CREATE TABLE "crypto_candles_packed" (
+  "c_id" integer NOT NULL,
+  "resolution" varchar(2) NOT NULL,
+  "day" date NOT NULL,
+  "time" integer[] NOT NULL,
+  "open" double precision[] NOT NULL,
+  "high" double precision[] NOT NULL,
+  "low" double precision[] NOT NULL,
+  "close" double precision[] NOT NULL,
+  "volume" bigint[] NOT NULL,
+  PRIMARY KEY ("c_id", "resolution", "day")
+);
+
+CREATE TABLE "fetch_coverage" (
+  "dataset" varchar(32) NOT NULL,
+  "c_id" integer NOT NULL,
+  "resolution" varchar(2) NOT NULL,
+  "startdate" timestamp NOT NULL,
+  "enddate" timestamp NOT NULL,
+  PRIMARY KEY ("dataset", "c_id", "resolution", "startdate")
+);
+
+CREATE TABLE "watermarks" (
+  "dataset" varchar(32) NOT NULL,
+  "c_id" integer NOT NULL,
+  "resolution" varchar(2) NOT NULL,
+  "date" timestamp NOT NULL,
+  PRIMARY KEY ("dataset", "c_id", "resolution")
 );
 
 ALTER TABLE "sec_sentiment" ADD FOREIGN KEY ("c_id") REFERENCES "companies" ("id");
@@ -191,6 +236,10 @@ ALTER TABLE "earnings_calendars" ADD FOREIGN KEY ("c_id") REFERENCES "companies"
 
 ALTER TABLE "crypto_candles" ADD FOREIGN KEY ("c_id") REFERENCES "crypto" ("id");
 
+ALTER TABLE "stocks_candles_packed" ADD FOREIGN KEY ("c_id") REFERENCES "companies" ("id");
+
+ALTER TABLE "crypto_candles_packed" ADD FOREIGN KEY ("c_id") REFERENCES "crypto" ("id");
+
 CREATE UNIQUE INDEX ON "sec_sentiment" ("c_id", "date", "form", "access_number");
 
 CREATE UNIQUE INDEX ON "sec_similarity" ("c_id", "date", "form", "access_number");
@@ -214,3 +263,61 @@ CREATE UNIQUE INDEX ON "upgrades_downgrades" ("c_id", "date");
 CREATE UNIQUE INDEX ON "earnings_calendars" ("c_id", "date");
 
 CREATE UNIQUE INDEX ON "crypto_candles" ("c_id", "date", "resolution");
+
+CREATE INDEX "dividends_c_id_sort_date_id_idx" ON "dividends" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "earnings_calendars_c_id_sort_date_id_idx" ON "earnings_calendars" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "eps_estimates_c_id_sort_date_id_idx" ON "eps_estimates" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "eps_surprises_c_id_sort_date_id_idx" ON "eps_surprises" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "revenue_estimates_c_id_sort_date_id_idx" ON "revenue_estimates" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "sec_sentiment_c_id_sort_date_id_idx" ON "sec_sentiment" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "sec_similarity_c_id_sort_date_id_idx" ON "sec_similarity" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "splits_c_id_sort_date_id_idx" ON "splits" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "trends_c_id_sort_date_id_idx" ON "trends" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE INDEX "upgrades_downgrades_c_id_sort_date_id_idx" ON "upgrades_downgrades" ("c_id", (coalesce("date", '-infinity'::timestamp)), "id");
+
+CREATE FUNCTION "create_monthly_partitions" ("parent" text, "startdate" timestamp, "enddate" timestamp)
+RETURNS void AS $$
+DECLARE
+  "month" timestamp := date_trunc('month', "startdate");
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext("parent"));
+  WHILE "month" <= "enddate" LOOP
+    EXECUTE format(
+      'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+      "parent" || '_' || to_char("month", 'YYYY_MM'), "parent", "month", "month" + interval '1 month'
+    );
+    "month" := "month" + interval '1 month';
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION "merge_coverage" (
+  "dataset" text, "c_id" integer, "resolution" text, "startdate" timestamp, "enddate" timestamp
+)
+RETURNS void AS $$
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext(concat_ws(':', "dataset", "c_id", "resolution")));
+  WITH "merged" AS (
+    DELETE FROM "fetch_coverage" AS f
+    WHERE f."dataset" = merge_coverage."dataset"
+      AND f."c_id" = merge_coverage."c_id"
+      AND f."resolution" = merge_coverage."resolution"
+      AND f."startdate" <= merge_coverage."enddate"
+      AND f."enddate" >= merge_coverage."startdate"
+    RETURNING f."startdate", f."enddate"
+  )
+  INSERT INTO "fetch_coverage" ("dataset", "c_id", "resolution", "startdate", "enddate")
+  SELECT merge_coverage."dataset", merge_coverage."c_id", merge_coverage."resolution",
+    least(min(m."startdate"), merge_coverage."startdate"), greatest(max(m."enddate"), merge_coverage."enddate")
+  FROM "merged" AS m;
+END;
+$$ LANGUAGE plpgsql;